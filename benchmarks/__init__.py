@@ -0,0 +1,125 @@
+'''benchmarks for tubes, intertubes, feedformatter and the vendored libraries
+
+the benchmarks run in process, run them from the root of the project with
+
+    python -m benchmarks
+
+and see python -m benchmarks --help for the options to save a baseline and
+compare against it
+'''
+import gc
+import time
+
+# (name, setup function) in the order they were registered
+BENCHMARKS = []
+
+def benchmark(name):
+    '''decorator to register a benchmark, the decorated function is called
+    once to set up the data and must return a function without arguments that
+    runs one operation'''
+    def wrapper(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+
+    return wrapper
+
+def _run(func, loops):
+    '''call func loops times and return the elapsed time in seconds'''
+    started = time.time()
+
+    for i in xrange(loops):
+        func()
+
+    return time.time() - started
+
+def measure(func, min_time=0.2, repeat=3):
+    '''return a dict with the operations per second of func, the best of
+    repeat runs of at least min_time seconds each, and the number of objects
+    tracked by the garbage collector that are left alive per operation,
+    either leaked or in reference cycles that only the collector frees'''
+    func()
+    loops = 1
+
+    while True:
+        elapsed = _run(func, loops)
+
+        if elapsed >= min_time:
+            break
+
+        if elapsed <= 0:
+            loops *= 10
+        else:
+            loops = max(loops * 2, int(loops * min_time / elapsed) + 1)
+
+    best = elapsed
+
+    for i in xrange(repeat - 1):
+        best = min(best, _run(func, loops))
+
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        # with the collector disabled the first count is the number of
+        # objects allocated minus the ones deallocated since the last
+        # collection
+        before = gc.get_count()[0]
+        _run(func, loops)
+        objects = gc.get_count()[0] - before
+    finally:
+        if enabled:
+            gc.enable()
+
+    return {'ops': loops / best, 'objects': float(objects) / loops}
+
+def load_benchmarks():
+    '''import the modules that register the benchmarks'''
+    from benchmarks import dispatch, jsonclass, codegen, feeds, serialization
+
+def run_benchmarks(pattern=None, min_time=0.2, repeat=3, callback=None):
+    '''run the benchmarks whose name contains pattern (all if None) and
+    return a dict of name -> result of measure, callback is called with the
+    name and the result of each benchmark as they finish'''
+    load_benchmarks()
+    results = {}
+
+    for name, setup in BENCHMARKS:
+        if pattern is not None and pattern not in name:
+            continue
+
+        func = setup()
+
+        if func is None:
+            # not available in this environment
+            continue
+
+        results[name] = result = measure(func, min_time, repeat)
+
+        if callback is not None:
+            callback(name, result)
+
+    return results
+
+def compare(results, baseline, threshold=0.1, objects_threshold=1):
+    '''return a list of (name, reason) for the results that are more than
+    threshold (a fraction) slower than the baseline or leave more than
+    objects_threshold objects alive per operation than it'''
+    regressions = []
+
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        result = results[name]
+        base = baseline[name]
+
+        if result['ops'] < base['ops'] * (1 - threshold):
+            regressions.append((name, '%.1f%% slower' %
+                ((1 - result['ops'] / base['ops']) * 100, )))
+
+        if result['objects'] > base['objects'] + objects_threshold:
+            regressions.append((name, '%.1f more objects per operation' %
+                (result['objects'] - base['objects'], )))
+
+    return regressions
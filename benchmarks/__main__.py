@@ -0,0 +1,92 @@
+'''run the benchmarks and compare them with a baseline
+
+    python -m benchmarks [-f name] [--save] [-b baseline.json] [-t 0.1]
+
+the exit status is 1 if a benchmark regressed more than the threshold
+'''
+import os
+import sys
+import optparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks import run_benchmarks, compare
+
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+def main(args=None):
+    '''parse the arguments, run the benchmarks and report them'''
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-f', '--filter', dest='pattern', default=None,
+            help='run only the benchmarks whose name contains PATTERN',
+            metavar='PATTERN')
+    parser.add_option('-b', '--baseline', dest='baseline', default=BASELINE,
+            help='the baseline file [default: %default]')
+    parser.add_option('-s', '--save', dest='save', action='store_true',
+            default=False, help='save the results as the new baseline')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+            default=0.1, help='the slowdown that is reported as a regression'
+            ' as a fraction [default: %default]')
+    parser.add_option('-m', '--min-time', dest='min_time', type='float',
+            default=0.2, help='the minimum seconds of each run '
+            '[default: %default]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+            default=3, help='the number of runs, the best one is kept '
+            '[default: %default]')
+    options, args = parser.parse_args(args)
+
+    baseline = {}
+
+    if os.path.exists(options.baseline):
+        handle = open(options.baseline)
+
+        try:
+            baseline = json.load(handle)
+        finally:
+            handle.close()
+
+    def report(name, result):
+        '''print the result of a benchmark'''
+        base = baseline.get(name, None)
+
+        if base is None:
+            change = ''
+        else:
+            change = '%+.1f%%' % ((result['ops'] / base['ops'] - 1) * 100, )
+
+        print '%-40s %14.1f ops/s %8.1f objects/op %8s' % (name,
+                result['ops'], result['objects'], change)
+        sys.stdout.flush()
+
+    results = run_benchmarks(options.pattern, options.min_time,
+            options.repeat, report)
+
+    if options.save:
+        baseline.update(results)
+        handle = open(options.baseline, 'w')
+
+        try:
+            json.dump(baseline, handle, indent=2, sort_keys=True)
+        finally:
+            handle.close()
+
+        print 'baseline saved to', options.baseline
+        return 0
+
+    regressions = compare(results, baseline, options.threshold)
+
+    for name, reason in regressions:
+        print 'REGRESSION %s: %s' % (name, reason)
+
+    return regressions and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
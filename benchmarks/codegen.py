@@ -0,0 +1,39 @@
+'''benchmarks of the code generated by intertubes'''
+import tubes
+import intertubes
+
+from benchmarks import benchmark
+from benchmarks.jsonclass import make_class
+
+def make_handler(count=20):
+    '''return a handler with count routes of different kinds'''
+    handler = tubes.Handler()
+
+    for index in xrange(count):
+        def get_user(request, name):
+            return name
+
+        def create_user(request, user):
+            return user
+
+        handler.register_route('GET', '^/users%d/(.*?)/?$' % (index, ),
+                get_user, None, tubes.JSON, False, None)
+        handler.register_route('POST', '^/users%d/?$' % (index, ),
+                create_user, tubes.JSON, tubes.JSON, True, None)
+
+    return handler
+
+@benchmark('intertubes requests')
+def intertubes_requests():
+    handler = make_handler()
+    return lambda: intertubes.generate_requests(handler)
+
+@benchmark('intertubes html example')
+def intertubes_html_example():
+    handler = make_handler()
+    return lambda: intertubes.generate_html_example(handler)
+
+@benchmark('intertubes model')
+def intertubes_model():
+    classes = [make_class() for index in xrange(10)]
+    return lambda: intertubes.generate_model(classes)
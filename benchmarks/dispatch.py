@@ -0,0 +1,105 @@
+'''benchmarks of the dispatch of requests by tubes.Handler'''
+import tubes
+
+from werkzeug import Client, BaseResponse
+
+from benchmarks import benchmark
+
+def make_client(count):
+    '''return a client for a handler with count routes and the path handled
+    by the last one'''
+    handler = tubes.Handler()
+
+    for index in xrange(count):
+        def get_item(request, item_id):
+            return {'id': item_id}
+
+        handler.register_route('GET', '^/items%d/(\\d+)$' % (index, ),
+                get_item, None, tubes.JSON, False, None)
+
+    return Client(handler, BaseResponse), '/items%d/42' % (count - 1, )
+
+def dispatch(count):
+    '''return a benchmark that requests the last of count routes'''
+    def setup():
+        client, path = make_client(count)
+        return lambda: client.get(path, buffered=True)
+
+    return setup
+
+for count in (10, 100, 1000):
+    benchmark('dispatch %d routes' % (count, ))(dispatch(count))
+
+@benchmark('dispatch not found 100 routes')
+def dispatch_not_found():
+    client, path = make_client(100)
+    return lambda: client.get('/missing', buffered=True)
+
+@benchmark('dispatch json body')
+def dispatch_json_body():
+    handler = tubes.Handler()
+
+    @handler.post('^/echo$', accepts=tubes.JSON)
+    def echo(request, body):
+        return body
+
+    client = Client(handler, BaseResponse)
+    data = '{"name": "bob", "tags": ["a", "b", "c"], "age": 42}'
+    return lambda: client.post('/echo', data=data,
+            content_type=tubes.JSON, buffered=True)
+
+@benchmark('dispatch ndjson large records')
+def dispatch_ndjson_large_records():
+    handler = tubes.Handler()
+
+    @handler.post('^/bulk$', accepts=tubes.NDJSON)
+    def bulk(request, records):
+        return [len(record['body']) for record in records]
+
+    client = Client(handler, BaseResponse)
+    # records bigger than the reads of iter_ndjson
+    sizes = [30000, 100, 70000]
+    data = '\n'.join(tubes.json.dumps({'body': 'x' * size})
+            for size in sizes) + '\n'
+    response = client.post('/bulk', data=data, content_type=tubes.NDJSON,
+            buffered=True)
+    assert tubes.json.loads(response.data) == sizes, response.data
+    return lambda: client.post('/bulk', data=data,
+            content_type=tubes.NDJSON, buffered=True)
+
+@benchmark('dispatch routes that are matched alone')
+def dispatch_matched_alone():
+    handler = tubes.Handler()
+    patterns = ['^/a/(\\d+)$', '^/x/(y)?(?(1)z|w)$', '^/Admin$',
+            '(?i)^/public$', '^/b/(\\w)\\1$']
+
+    def make_get(name):
+        def get(request, *args):
+            return name
+
+        return get
+
+    for index, pattern in enumerate(patterns):
+        handler.register_route('GET', pattern, make_get(str(index)), None,
+                tubes.TEXT, False, None)
+
+    client = Client(handler, BaseResponse)
+
+    # the combined routes must answer like re.match on each pattern
+    for path in ('/a/1', '/x/yz', '/x/yw', '/x/w', '/admin', '/Admin',
+            '/PUBLIC', '/b/aa', '/b/ab'):
+        expected = '404'
+
+        for index, pattern in enumerate(patterns):
+            if tubes.re.match(pattern, path):
+                expected = str(index)
+                break
+
+        response = client.get(path, buffered=True)
+
+        if response.status_code == 404:
+            assert expected == '404', (path, expected)
+        else:
+            assert response.data == expected, (path, response.data, expected)
+
+    return lambda: client.get('/x/yz', buffered=True)
@@ -0,0 +1,39 @@
+'''benchmarks of the generation of atom feeds by feedformatter'''
+import os
+import sys
+import time
+
+from benchmarks import benchmark
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'ihasfriendz'))
+
+from feedformatter import Feed
+
+def make_feed(count):
+    '''return a feed with count items like the streams of ihasfriendz'''
+    feed = Feed()
+    feed.feed['title'] = 'live stream'
+    feed.feed['link'] = 'http://localhost:8081/atom/stream/'
+    feed.feed['author'] = 'http://localhost:8081/'
+
+    for index in xrange(count):
+        feed.items.append({
+            'title': 'notice %d' % (index, ),
+            'link': 'http://localhost:8081/notice/%d' % (index, ),
+            'description': 'the body of the notice number %d' % (index, ),
+            'pubDate': time.localtime(1262304000 + index),
+            'guid': 'notice-%d' % (index, )})
+
+    return feed
+
+def atom(count):
+    '''return a benchmark that formats a feed of count items'''
+    def setup():
+        feed = make_feed(count)
+        return feed.format_atom_string
+
+    return setup
+
+for count in (1, 10, 100, 1000):
+    benchmark('atom feed %d items' % (count, ))(atom(count))
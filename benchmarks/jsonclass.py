@@ -0,0 +1,45 @@
+'''benchmarks of the serialization of tubes.JsonClass instances'''
+import tubes
+
+from benchmarks import benchmark
+
+class User(object):
+    '''a user'''
+
+    def __init__(self, name=None, first_name=None, last_name=None, mail=None,
+            age=None):
+        self.name = name
+        self.first_name = first_name
+        self.last_name = last_name
+        self.mail = mail
+        self.age = age
+
+def make_class(**kwargs):
+    '''return a JsonClass version of User created with kwargs'''
+    return tubes.JsonClass(**kwargs)(type('User', (User, ), {}))
+
+def round_trip(cls):
+    '''return a benchmark that serializes and deserializes a cls'''
+    user = cls('bob', 'Bob', 'Dylan', 'bob@example.com', 42)
+
+    return lambda: cls.from_json_str(user.to_json_str())
+
+@benchmark('jsonclass round trip')
+def jsonclass_round_trip():
+    return round_trip(make_class())
+
+@benchmark('jsonclass round trip slots')
+def jsonclass_round_trip_slots():
+    return round_trip(make_class(slots=True))
+
+@benchmark('jsonclass round trip camelcase')
+def jsonclass_round_trip_camelcase():
+    return round_trip(make_class(naming=tubes.CAMELCASE))
+
+@benchmark('jsonclass list 100')
+def jsonclass_list():
+    cls = make_class()
+    users = [cls('bob%d' % (index, ), 'Bob', 'Dylan', 'bob@example.com',
+        index) for index in xrange(100)]
+
+    return lambda: cls.from_json_list_str(cls.to_json_list_str(users))
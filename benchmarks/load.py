@@ -0,0 +1,393 @@
+'''HTTP load generator for tubes.run servers
+
+starts the application of a workload with tubes.run in each server mode,
+replays the scripted requests of the workload against it at a fixed
+concurrency or rate and reports the latency percentiles, the throughput and
+the error rate of each mode, run it from the root of the project with
+
+    python -m benchmarks.load -w ihasfriendz -m serial,threaded,forking -c 8
+
+or with -r 200 to send 200 requests per second instead of keeping 8 requests
+in flight, see --help for the rest of the options
+'''
+import os
+import sys
+import math
+import time
+import random
+import signal
+import socket
+import httplib
+import optparse
+import threading
+import subprocess
+from Queue import Queue, Empty
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import tubes
+
+from werkzeug import Client, BaseResponse
+
+# name -> function that returns the keyword arguments for tubes.run given
+# the number of workers
+MODES = {
+    'serial': lambda workers: {},
+    'threaded': lambda workers: {'threaded': True},
+    'pool': lambda workers: {'threaded': True, 'pool_size': workers},
+    'forking': lambda workers: {'processes': workers},
+    'prefork': lambda workers: {'processes': workers, 'prefork': True},
+    'async': lambda workers: {'event_loop': True, 'pool_size': workers},
+}
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+class Workload(object):
+    '''a scripted mix of requests against an application
+
+    make_handler is called in the server process and returns the handler to
+    serve, setup is a list of requests sent to it in process before serving
+    so the processes of the multi process modes start with the same state
+    and requests a list of (weight, request), a request is a tuple of (name,
+    method, path, body, content type)'''
+
+    def __init__(self, make_handler, setup, requests):
+        self.make_handler = make_handler
+        self.setup = setup
+        self.requests = []
+        self.weights = []
+        total = 0
+
+        for weight, request in requests:
+            total += weight
+            self.weights.append(total)
+            self.requests.append(request)
+
+    def choose(self, rand):
+        '''return a random request of the mix'''
+        point = rand.random() * self.weights[-1]
+
+        for weight, request in zip(self.weights, self.requests):
+            if point < weight:
+                return request
+
+        return self.requests[-1]
+
+def hello_handler():
+    '''return a handler that does the minimum, to measure the server'''
+    handler = tubes.Handler()
+
+    @handler.get('^/hello/?$')
+    def hello(request):
+        return 'hello'
+
+    return handler
+
+def ihasfriendz_handler():
+    '''return the handler of the ihasfriendz example'''
+    directory = os.path.join(ROOT, 'ihasfriendz')
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+
+    import main
+
+    # the hub isn't part of the stack being measured
+    main.pshb.publish = lambda hub, *urls: None
+    return main.handler
+
+def _notice(title):
+    '''return the body of a request to create a notice'''
+    return json.dumps({'title': title, 'body': 'lorem ipsum dolor sit amet',
+        'author': 'bob'})
+
+WORKLOADS = {
+    'hello': Workload(hello_handler, [],
+        [(1, ('hello', 'GET', '/hello', None, None))]),
+    'ihasfriendz': Workload(ihasfriendz_handler,
+        [('create user', 'POST', '/user/', json.dumps({'user': 'bob',
+            'mail': 'bob@example.com', 'firstname': 'Bob',
+            'lastname': 'Dylan'}), tubes.JSON),
+         ('create notice', 'POST', '/notice/', _notice('first'),
+             tubes.JSON)],
+        [(1, ('create notice', 'POST', '/notice/', _notice('hi'),
+            tubes.JSON)),
+         (3, ('read stream', 'GET', '/stream/bob', None, None)),
+         (1, ('read atom stream', 'GET', '/atom/stream/bob', None, None))]),
+}
+
+def serve(workload, mode, port, workers):
+    '''run the application of workload in mode, called in the server
+    process'''
+    workload = WORKLOADS[workload]
+    handler = workload.make_handler()
+    client = Client(handler, BaseResponse)
+
+    for name, method, path, body, content_type in workload.setup:
+        client.open(path, method=method, data=body, content_type=content_type,
+                buffered=True)
+
+    tubes.run(handler, '127.0.0.1', port, **MODES[mode](workers))
+
+def start_server(workload, mode, port, workers, verbose=False, timeout=10):
+    '''start a server process and wait until it accepts connections'''
+    command = [sys.executable, '-m', 'benchmarks.load', '--serve', mode,
+        '-w', workload, '-p', str(port), '--workers', str(workers)]
+
+    if verbose:
+        output = None
+    else:
+        # the servers log every request
+        output = open(os.devnull, 'w')
+
+    process = subprocess.Popen(command, cwd=ROOT, stdout=output,
+            stderr=output)
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('the %s server exited with status %d' %
+                    (mode, process.returncode))
+
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+
+    stop_server(process)
+    raise RuntimeError('the %s server didn\'t start in %d seconds' %
+            (mode, timeout))
+
+def stop_server(process, timeout=5):
+    '''stop a server started by start_server'''
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+
+    deadline = time.time() + timeout
+
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+def send(connection, request):
+    '''send request on connection and return the status of the response'''
+    name, method, path, body, content_type = request
+    headers = {}
+
+    if content_type is not None:
+        headers['Content-Type'] = content_type
+
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+class LoadClient(threading.Thread):
+    '''a connection that sends requests until stopped, if schedule is not
+    None it takes the time each request must be sent from it and the latency
+    is measured from that time, otherwise the requests are sent one after
+    another'''
+
+    def __init__(self, workload, port, deadline, schedule=None, seed=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.workload = workload
+        self.port = port
+        self.deadline = deadline
+        self.schedule = schedule
+        self.random = random.Random(seed)
+        # (start, latency in seconds, True if it failed)
+        self.results = []
+
+    def run(self):
+        connection = httplib.HTTPConnection('127.0.0.1', self.port)
+
+        while True:
+            if self.schedule is None:
+                started = time.time()
+
+                if started >= self.deadline:
+                    break
+            else:
+                try:
+                    started = self.schedule.get(timeout=0.1)
+                except Empty:
+                    if time.time() >= self.deadline:
+                        break
+
+                    continue
+
+                if started >= self.deadline:
+                    break
+
+                delay = started - time.time()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+            try:
+                failed = send(connection,
+                        self.workload.choose(self.random)) >= 400
+            except (socket.error, httplib.HTTPException):
+                failed = True
+                connection.close()
+                connection = httplib.HTTPConnection('127.0.0.1', self.port)
+
+            self.results.append((started, time.time() - started, failed))
+
+        connection.close()
+
+def run_load(workload, port, duration, concurrency, rate=None, warmup=1):
+    '''send the requests of workload for warmup + duration seconds and
+    return the results of the last duration seconds'''
+    start = time.time()
+    deadline = start + warmup + duration
+    schedule = None
+
+    if rate is not None:
+        schedule = Queue()
+
+    clients = [LoadClient(workload, port, deadline, schedule, index)
+            for index in xrange(concurrency)]
+
+    for client in clients:
+        client.start()
+
+    if schedule is not None:
+        count = int((warmup + duration) * rate)
+
+        for index in xrange(count):
+            scheduled = start + index / float(rate)
+            delay = scheduled - time.time()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            schedule.put(scheduled)
+
+    for client in clients:
+        client.join()
+
+    measured_from = start + warmup
+    return [result for client in clients for result in client.results
+            if result[0] >= measured_from]
+
+def percentile(values, percent):
+    '''return the nearest rank percentile of the sorted values'''
+    if not values:
+        return 0
+
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def summarize(results, duration):
+    '''return a dict with the statistics of the results'''
+    latencies = sorted(latency for started, latency, failed in results)
+    errors = len([failed for started, latency, failed in results if failed])
+    summary = {
+        'requests': len(results),
+        'throughput': len(results) / float(duration),
+        'error_rate': len(results) and errors / float(len(results)),
+        'max': latencies and latencies[-1] or 0}
+
+    for percent in PERCENTILES:
+        summary['p%s' % (percent, )] = percentile(latencies, percent)
+
+    return summary
+
+def format_summary(mode, summary):
+    '''return a line of the report'''
+    return '%-10s %9d %10.1f %8.2f%% ' % (mode, summary['requests'],
+            summary['throughput'], summary['error_rate'] * 100) + \
+            ' '.join('%9.2f' % (summary['p%s' % (percent, )] * 1000, )
+                for percent in PERCENTILES) + \
+            ' %9.2f' % (summary['max'] * 1000, )
+
+def main(args=None):
+    '''parse the arguments, load the servers and print the report'''
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-w', '--workload', dest='workload',
+            default='ihasfriendz', help='the workload to replay, one of ' +
+            ', '.join(sorted(WORKLOADS)) + ' [default: %default]')
+    parser.add_option('-m', '--modes', dest='modes',
+            default='serial,threaded,forking',
+            help='comma separated server modes to measure, of ' +
+            ', '.join(sorted(MODES)) + ' [default: %default]')
+    parser.add_option('-c', '--concurrency', dest='concurrency', type='int',
+            default=8, help='the number of connections sending requests '
+            '[default: %default]')
+    parser.add_option('-r', '--rate', dest='rate', type='float',
+            default=None, help='send this many requests per second instead '
+            'of sending the next request when the previous one finishes')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+            default=10, help='the seconds measured per mode '
+            '[default: %default]')
+    parser.add_option('--warmup', dest='warmup', type='float', default=1,
+            help='the seconds of load before measuring [default: %default]')
+    parser.add_option('--workers', dest='workers', type='int', default=4,
+            help='the processes or threads of the modes that have a fixed '
+            'number [default: %default]')
+    parser.add_option('-p', '--port', dest='port', type='int', default=8765,
+            help='the port the servers listen on [default: %default]')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+            default=False, help='show the output of the servers')
+    parser.add_option('--serve', dest='serve', default=None,
+            help='run the server of the workload in this mode, used '
+            'internally')
+    options, args = parser.parse_args(args)
+
+    if options.workload not in WORKLOADS:
+        parser.error('unknown workload %r' % (options.workload, ))
+
+    if options.serve is not None:
+        serve(options.workload, options.serve, options.port, options.workers)
+        return 0
+
+    modes = options.modes.split(',')
+
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('unknown mode %r' % (mode, ))
+
+    workload = WORKLOADS[options.workload]
+
+    if options.rate is None:
+        load = 'concurrency %d' % (options.concurrency, )
+    else:
+        load = '%g requests/s on %d connections' % (options.rate,
+                options.concurrency)
+
+    print 'workload %s, %s, %gs per mode' % (options.workload, load,
+            options.duration)
+    print '%-10s %9s %10s %9s ' % ('mode', 'requests', 'req/s', 'errors') + \
+            ' '.join('%9s' % ('p%s ms' % (percent, ), )
+                for percent in PERCENTILES) + ' %9s' % ('max ms', )
+
+    for mode in modes:
+        process = start_server(options.workload, mode, options.port,
+                options.workers, options.verbose)
+
+        try:
+            results = run_load(workload, options.port, options.duration,
+                    options.concurrency, options.rate, options.warmup)
+        finally:
+            stop_server(process)
+
+        print format_summary(mode, summarize(results, options.duration))
+        sys.stdout.flush()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
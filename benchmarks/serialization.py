@@ -0,0 +1,76 @@
+'''benchmarks of the vendored simplejson with and without _speedups'''
+import simplejson
+import simplejson.decoder
+import simplejson.encoder
+import simplejson.scanner
+
+from benchmarks import benchmark
+
+try:
+    from simplejson import _speedups
+except ImportError:
+    _speedups = None
+
+DOCUMENT = {
+    'users': [{'name': u'user%d' % (index, ), 'age': index,
+        'mail': 'user%d@example.com' % (index, ), 'active': index % 2 == 0,
+        'score': index * 1.5, 'tags': ['a', 'b', u'\xe1'],
+        'bio': 'a "quoted" text with a\nnew line'}
+        for index in xrange(50)],
+    'count': 50,
+    'next': None}
+
+def set_speedups(enabled):
+    '''enable or disable the C speedups of simplejson, return False if they
+    can't be enabled because the extension isn't compiled'''
+    if enabled and _speedups is None:
+        return False
+
+    decoder = simplejson.decoder
+    encoder = simplejson.encoder
+    scanner = simplejson.scanner
+
+    if enabled:
+        decoder.scanstring = _speedups.scanstring
+        scanner.make_scanner = _speedups.make_scanner
+        encoder.c_make_encoder = _speedups.make_encoder
+        encoder.encode_basestring_ascii = _speedups.encode_basestring_ascii
+    else:
+        decoder.scanstring = decoder.py_scanstring
+        scanner.make_scanner = scanner.py_make_scanner
+        encoder.c_make_encoder = None
+        encoder.encode_basestring_ascii = encoder.py_encode_basestring_ascii
+
+    decoder.make_scanner = scanner.make_scanner
+    # the default instances keep references to the functions
+    simplejson._default_decoder = simplejson.JSONDecoder(encoding=None,
+            object_hook=None)
+    simplejson._default_encoder = simplejson.JSONEncoder(skipkeys=False,
+            ensure_ascii=True, check_circular=True, allow_nan=True,
+            indent=None, separators=None, encoding='utf-8', default=None)
+    return True
+
+def encode(enabled):
+    '''return a benchmark that encodes DOCUMENT'''
+    def setup():
+        if not set_speedups(enabled):
+            return None
+
+        return lambda: simplejson.dumps(DOCUMENT)
+
+    return setup
+
+def decode(enabled):
+    '''return a benchmark that decodes DOCUMENT'''
+    def setup():
+        if not set_speedups(enabled):
+            return None
+
+        data = simplejson.dumps(DOCUMENT)
+        return lambda: simplejson.loads(data)
+
+    return setup
+
+for enabled, suffix in ((False, 'python'), (True, 'speedups')):
+    benchmark('simplejson encode %s' % (suffix, ))(encode(enabled))
+    benchmark('simplejson decode %s' % (suffix, ))(decode(enabled))
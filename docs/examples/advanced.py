@@ -78,7 +78,7 @@ def remove_user(handler, username):
 @handler.get('^/requests.js/?$', produces=tubes.JS)
 def requests(request):
     '''return the requests.js file to interact with this API'''
-    return tubes.Response(REQUESTS)
+    return REQUESTS
 
 # return the generated model javascript code on that url
 # (on production you should save it to a file)
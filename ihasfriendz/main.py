@@ -19,6 +19,7 @@ import intertubes as h
 
 import pubsubhubbub_publish as pshb
 from feedformatter import Feed
+from werkzeug.contrib.cache import SimpleCache
 
 
 PORT = 8081
@@ -32,9 +33,10 @@ notices = {}
 user_notices = {}
 stream = []
 new_notices = Queue.Queue()
+users_cache = SimpleCache()
 
 # remove the comment below if you have python 2.6 or above
-#@tubes.JsonClass()
+#@tubes.JsonClass(slots=True)
 class User(object):
     """a class that represents an user"""
 
@@ -48,10 +50,10 @@ class User(object):
         self.website = website
 
 # for python 2.5 compatibility
-User = tubes.JsonClass()(User)
+User = tubes.JsonClass(slots=True)(User)
 
 # remove the comment below if you have python 2.6 or above
-#@tubes.JsonClass()
+#@tubes.JsonClass(slots=True)
 class Notice(object):
     """a class that represents a notice"""
 
@@ -70,7 +72,7 @@ class Notice(object):
             self.creation = time.time()
 
 # for python 2.5 compatibility
-Notice = tubes.JsonClass()(Notice)
+Notice = tubes.JsonClass(slots=True)(Notice)
 
 def parse_notices(data):
     """extract notices from an atom feed
@@ -146,7 +148,7 @@ def show_user(request, username):
 
     return tubes.Response('nothing to see here, please move along', 404)
 
-@handler.get('^/users/?$', produces=tubes.HTML)
+@handler.get('^/users/?$', produces=tubes.HTML, cache=users_cache)
 def show_users(request):
     return json.dumps([user.to_json() for user in users.values()])
 
@@ -170,7 +172,7 @@ def show_stream(request, username):
     else:
         return tubes.Response('nothing to see here, please move along', 404)
 
-    content = [notice_to_html(notices) for notice in notices]
+    content = [notice_to_html(notice) for notice in notices]
     css = h.css('/files/style.css')
     html = h.html(h.head(h.title('notices'), css), h.body(*content))
 
@@ -186,11 +188,12 @@ def show_stream_atom(request, username):
 
     return tubes.Response('nothing to see here, please move along', 404)
 
-@handler.post('^/user/?$', accepts=tubes.JSON, transform_body=User.from_json)
+@handler.post('^/user/?$', accepts=tubes.JSON, body_class=User)
 def create_user_json(request, user):
     users[user.user] = user
+    handler.invalidate('/users/')
 
-@handler.post('^/notice/?$', accepts=tubes.JSON, transform_body=Notice.from_json)
+@handler.post('^/notice/?$', accepts=tubes.JSON, body_class=Notice)
 def create_notice_json(request, notice):
     notice.uid = str(uuid.uuid4())
     notice.creation = time.time()
@@ -209,17 +212,17 @@ def create_notice_json(request, notice):
 @handler.get('^/requests.js/?$', produces=tubes.JS)
 def requests(request):
     '''return the requests.js file to interact with this API'''
-    return tubes.Response(REQUESTS)
+    return CLIENT['/requests.js']
 
 @handler.get('^/model.js/?$', produces=tubes.JS)
 def model(request):
     '''return the model.js file to interact with this API'''
-    return MODEL
+    return CLIENT['/model.js']
 
 @handler.get('^/test.html/?$', produces=tubes.HTML)
 def test(request):
     '''return a dummy html to play with the API'''
-    return TEST_PAGE
+    return CLIENT['/test.html']
 
 @handler.get('^/?$', produces=tubes.HTML)
 def index(request):
@@ -255,10 +258,20 @@ def get_new_notices(request):
 
     return str(html)
 
-REQUESTS = intertubes.generate_requests(handler)
-MODEL = intertubes.generate_model([User, Notice])
-TEST_PAGE = intertubes.generate_html_example(handler,
-        ('/files/json2.js', '/model.js'))
+# the client code is generated at build time with "python main.py build",
+# if it wasn't it's generated on startup
+if os.path.exists(intertubes.CLIENT_MANIFEST):
+    CLIENT = intertubes.load_client(handler)
+else:
+    CLIENT = {
+        '/requests.js': intertubes.generate_requests(handler),
+        '/model.js': intertubes.generate_model([User, Notice]),
+        '/test.html': intertubes.generate_html_example(handler,
+            ('/files/json2.js', '/model.js'))}
 
 if __name__ == '__main__':
-    tubes.run(handler, port=PORT, use_reloader=True, use_debugger=True)
+    if sys.argv[1:] == ['build']:
+        intertubes.build_client(handler, [User, Notice],
+                js_paths=['/files/json2.js'])
+    else:
+        tubes.run(handler, port=PORT, use_reloader=True, use_debugger=True)
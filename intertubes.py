@@ -1,9 +1,17 @@
 '''some utilities that can be used with tubes'''
+import os
 import re
 import inspect
 
 import tubes
 
+# default directory and manifest of the files written by build_client
+CLIENT_DIRECTORY = 'client'
+CLIENT_MANIFEST = 'client.json'
+
+# function -> the result of inspect.getargspec, filled by get_argspec
+ARGSPECS = {}
+
 class STag(object):
     '''an object that represents a [x]html tag that closes on definition'''
     def __init__(self, name, **attrs):
@@ -84,37 +92,58 @@ def javascript(path=None, content=None):
     else:
         return script(content, type="text/javascript")
 
-def generate_model(classes, namespace='model', initialize_namespace=True):
-    code = ''
+def get_argspec(func):
+    '''return inspect.getargspec(func), cached per function'''
+    spec = ARGSPECS.get(func, None)
+
+    if spec is None:
+        spec = ARGSPECS[func] = inspect.getargspec(func)
+
+    return spec
+
+def route_args(route):
+    '''return the names of the arguments of the handler of route that are
+    taken from the url'''
+    if route.accepts in tubes.DECODED_TYPES:
+        return get_argspec(route.handler)[0][2:]
+
+    return get_argspec(route.handler)[0][1:]
+
+def minify_code(code):
+    '''return code without indentation, blank lines and line comments, only
+    safe for code without strings or comments that span lines like the
+    javascript and css generated here'''
+    lines = (line.strip() for line in code.splitlines())
+    return '\n'.join(line for line in lines
+            if line and not line.startswith('//'))
+
+def generate_model(classes, namespace='model', initialize_namespace=True,
+        minify=False):
+    '''return javascript code with a constructor for each class'''
+    parts = []
 
     if initialize_namespace:
-        code += 'var %s = {}\n\n' % (namespace, )
+        parts.append('var %s = {}\n\n' % (namespace, ))
 
     for class_ in classes:
-        code += class_constructor(class_, namespace)
+        parts.append(class_constructor(class_, namespace))
+
+    code = ''.join(parts)
+
+    if minify:
+        return minify_code(code)
 
     return code
 
 def class_constructor(class_, namespace='model'):
     '''return the constructor of a class in js'''
-    args = inspect.getargspec(class_.__init__)
-    def_offset = len(args[3])
-    common = args[0][1: -def_offset]
-    defaults = args[0][-def_offset:]
-    first = True
-
-    code = '%s.%s = function (%s) {\n    return {' % (namespace,
-            class_.__name__, ', '.join(args[0][1:]))
-
-    for arg in common:
-        if first:
-            first = False
-        else:
-            code += '        '
+    args, varargs, varkw, defaults = get_argspec(class_.__init__)
+    args = args[1:]
+    defaults = defaults or ()
+    common = len(args) - len(defaults)
+    fields = ['"%s": %s' % (arg, arg) for arg in args[:common]]
 
-        code += '"%s": %s,\n' % (arg, arg)
-
-    for arg, value in zip(defaults, args[3]):
+    for arg, value in zip(args[common:], defaults):
         if value is None:
             rep = 'null'
         elif value == True or value == False:
@@ -122,18 +151,10 @@ def class_constructor(class_, namespace='model'):
         else:
             rep = repr(value)
 
-        if first:
-            first = False
-        else:
-            code += '        '
-
-
-        code += '"%s": %s || %s,\n' % (arg, arg, rep)
-
-    code = code[:-2]
+        fields.append('"%s": %s || %s' % (arg, arg, rep))
 
-    code += '};\n};\n\n'
-    return code
+    return '%s.%s = function (%s) {\n    return {%s};\n};\n\n' % (namespace,
+            class_.__name__, ', '.join(args), ',\n        '.join(fields))
 
 def generate_api_test(routes):
     '''generate the html to test the API'''
@@ -143,17 +164,12 @@ def generate_api_test(routes):
             name = tubes.underscores_to_camelcase(route.handler.__name__)
             output_id = name + '-output'
             args = []
-            start_arg = 1
-
-            if route.accepts == tubes.JSON:
-                start_arg = 2
-
             tbl = table(class_='api-form', id=name)
             output = div(class_='output', id=output_id,
                     onclick="$(this).html('');")
             wrapper.add(div(h2(name), tbl, output, class_='api'))
 
-            for arg in inspect.getargspec(route.handler)[0][start_arg:]:
+            for arg in route_args(route):
                 argname = name + '-' + arg
                 args.append(argname)
                 tbl.add(tr(
@@ -161,7 +177,7 @@ def generate_api_test(routes):
                     td(input(type='text', id=argname, class_='value'),
                         class_='right')))
 
-            if route.has_payload or route.accepts == tubes.JSON:
+            if route.has_payload or route.accepts in tubes.DECODED_TYPES:
                 tbl.add(tr(
                     td("payload (eval)", class_='left'),
                     td(input(type='text', id=name + '--payload', class_='value'),
@@ -176,15 +192,22 @@ def generate_api_test(routes):
 
 def generate_html_example(handler, js_paths=None,
     jquery_path='/files/jquery-1.3.2.js',
-    requests_path='requests.js', namespace='requests'):
+    requests_path='requests.js', namespace='requests', minify=False):
     '''return a html file that will make use of the
     API defined on routes
     '''
     routes = handler.routes
-    head_tag = head(title('API test'), inline_css(EXAMPLE_CSS),
+    example_css = EXAMPLE_CSS
+    example_js = EXAMPLE_JS % (namespace, )
+
+    if minify:
+        example_css = minify_code(example_css)
+        example_js = minify_code(example_js)
+
+    head_tag = head(title('API test'), inline_css(example_css),
         javascript(path=jquery_path),
         javascript(path=requests_path),
-        javascript(content=EXAMPLE_JS % (namespace, )))
+        javascript(content=example_js))
 
     if js_paths is not None:
         for js_path in js_paths:
@@ -192,7 +215,7 @@ def generate_html_example(handler, js_paths=None,
 
     return str(html(head_tag, body(h1('API test'), generate_api_test(routes))))
 
-def generate_requests(handler, namespace='requests'):
+def generate_requests(handler, namespace='requests', minify=False):
     '''return javascript code to interact with this handler'''
     def get_rest_call(method, route):
         '''return a string representing a asynchornous REST call'''
@@ -203,14 +226,9 @@ def generate_requests(handler, namespace='requests'):
         if pattern.endswith('?'):
             pattern = pattern[:-1]
 
-        start_arg = 1
-
-        if route.accepts == tubes.JSON:
-            start_arg = 2
-
         parts = re.split('(\(.*?\))', pattern)
         result = ['"']
-        args = inspect.getargspec(route.handler)[0][start_arg:]
+        args = route_args(route)
 
         for part in parts:
             if part.startswith('('):
@@ -220,48 +238,122 @@ def generate_requests(handler, namespace='requests'):
                     '').replace('?', ''))
 
         result.append('"')
-        code  = "    var url = %s;\n" % (''.join(result), )
-        code += "    $.ajax({'contentType': '%s',\n" % (route.produces, )
+        code = ["    var url = %s;\n" % (''.join(result), ),
+                "    $.ajax({'contentType': '%s',\n" % (route.produces, )]
 
         if route.accepts == tubes.JSON:
-            code += "        'data': JSON.stringify(data),\n"
+            code.append("        'data': JSON.stringify(data),\n")
+        elif route.accepts == tubes.NDJSON:
+            code.append(
+                    "        'data': $.map(data, JSON.stringify).join('\\n'),\n")
         elif route.accepts is not None:
-            code += "        'data': data,\n"
+            code.append("        'data': data,\n")
 
-        code += "        'dataType': '%s',\n" % \
-                (tubes.JQUERY_TYPES.get(route.produces, 'text'),)
-        code += "        'error': onError,\n"
-        code += "        'success': onSuccess,\n"
-        code += "        'type': '%s',\n" % (method, )
-        code += "        'url': url});\n"
+        code.append("        'dataType': '%s',\n" %
+                (tubes.JQUERY_TYPES.get(route.produces, 'text'),))
+        code.append("        'error': onError,\n")
+        code.append("        'success': onSuccess,\n")
+        code.append("        'type': '%s',\n" % (method, ))
+        code.append("        'url': url});\n")
 
-        return code
+        return ''.join(code)
 
-    code  = 'var %s = {};\n\n' % (namespace,)
-    code += '%s.cb = function(response) {console.log(response);};\n\n' % \
-            (namespace, )
+    code = ['var %s = {};\n\n' % (namespace,),
+            '%s.cb = function(response) {console.log(response);};\n\n' %
+            (namespace, )]
 
     for method, routes in handler.routes.iteritems():
         for route in routes:
-            start_arg = 1
+            args = route_args(route)
 
-            if route.accepts == tubes.JSON:
-                start_arg = 2
-
-            args = inspect.getargspec(route.handler)[0][start_arg:]
-
-            if route.has_payload or route.accepts == tubes.JSON:
-                args += ['data']
+            if route.has_payload or route.accepts in tubes.DECODED_TYPES:
+                args.append('data')
 
             args += ['onSuccess', 'onError']
             method_name = tubes.underscores_to_camelcase(route.handler.__name__)
 
-            code += '// handle %s on %s\n' % (method, route.pattern)
-            code += '%s.%s = function(%s) {\n%s};\n\n' % (namespace,
-                    method_name, ', '.join(args), get_rest_call(method, route))
+            code.append('// handle %s on %s\n' % (method, route.pattern))
+            code.append('%s.%s = function(%s) {\n%s};\n\n' % (namespace,
+                    method_name, ', '.join(args), get_rest_call(method, route)))
+
+    code = ''.join(code)
+
+    if minify:
+        return minify_code(code)
 
     return code
 
+def write_file(path, content):
+    '''write content to the file at path'''
+    output = open(path, 'wb')
+
+    try:
+        output.write(content)
+    finally:
+        output.close()
+
+def build_client(handler, classes=None, directory=CLIENT_DIRECTORY,
+        manifest_path=CLIENT_MANIFEST, js_paths=None,
+        jquery_path='/files/jquery-1.3.2.js', namespace='requests',
+        model_namespace='model', minify=True):
+    '''generate requests.js, model.js (if classes is not None) and
+    test.html for handler on directory, content hash and precompress them
+    with tubes.build_assets and write the manifest to manifest_path (if not
+    None), return the manifest
+
+    meant to be run at build time, load the manifest on startup with
+    load_client, test.html links to the fingerprinted urls of the scripts
+    and of jquery_path and js_paths if they are on handler.assets
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    paths = {'/requests.js': os.path.join(directory, 'requests.js')}
+    write_file(paths['/requests.js'],
+            generate_requests(handler, namespace, minify))
+
+    if classes is not None:
+        paths['/model.js'] = os.path.join(directory, 'model.js')
+        write_file(paths['/model.js'],
+                generate_model(classes, model_namespace, minify=minify))
+
+    # the fingerprinted urls of the scripts are needed to write test.html
+    scripts = tubes.build_assets(paths, None)
+    js_paths = [handler.asset_url(path) for path in js_paths or ()]
+
+    if '/model.js' in scripts:
+        js_paths.append(scripts['/model.js']['url'])
+
+    paths['/test.html'] = os.path.join(directory, 'test.html')
+    write_file(paths['/test.html'], generate_html_example(handler, js_paths,
+        handler.asset_url(jquery_path), scripts['/requests.js']['url'],
+        namespace, minify))
+
+    return tubes.build_assets(paths, manifest_path)
+
+def load_client(handler, manifest_path=CLIENT_MANIFEST):
+    '''add the files of the manifest written by build_client to
+    handler.assets so tubes.run and tubes.run_gae serve their fingerprinted
+    urls, call it after handler.load_assets since that replaces
+    handler.assets
+
+    return a dict with the url of each file (like '/requests.js') as key and
+    its content as value to serve on the urls that aren't fingerprinted
+    '''
+    manifest = tubes.load_assets(manifest_path)
+    handler.assets.update(manifest)
+    contents = {}
+
+    for url, asset in manifest.iteritems():
+        input_file = open(asset['path'], 'rb')
+
+        try:
+            contents[url] = input_file.read()
+        finally:
+            input_file.close()
+
+    return contents
+
 EXAMPLE_CSS = """
 html, body, div, span{
  border: 0;
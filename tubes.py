@@ -1,8 +1,16 @@
 '''module to create REST APIS'''
 import os
 import re
-
+import zlib
+import time
+import bisect
+import threading
+
+import copy
+import hashlib
+import inspect
 import functools
+import mimetypes
 
 try:
     import json
@@ -13,6 +21,13 @@ import werkzeug
 from werkzeug import Request
 from werkzeug import Response
 from werkzeug import redirect
+from werkzeug import MIMEAccept
+from werkzeug import parse_accept_header
+from werkzeug import LimitedStream
+from werkzeug import generate_etag
+from werkzeug import wrap_file
+from werkzeug import is_resource_modified
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # http://www.sfsu.edu/training/mimetype.htm
 BIN  = 'application/octet-stream'
@@ -26,6 +41,11 @@ ICON = 'image/vnd.microsoft.icon'
 PDF  = 'application/pdf'
 RTF  = 'application/rtf'
 PNG  = 'image/png'
+NDJSON = 'application/x-ndjson'
+
+# content types of the request bodies that are decoded before calling the
+# handler
+DECODED_TYPES = (JSON, NDJSON)
 
 JQUERY_TYPES = {}
 JQUERY_TYPES[JSON] = 'json'
@@ -36,7 +56,8 @@ JQUERY_TYPES[XML]  = 'xml'
 class Route(object):
     '''a class that represents a registered route'''
     def __init__(self, pattern, handler, accepts=None, produces=TEXT,
-            has_payload=False, transform_body=None):
+            has_payload=False, transform_body=None, max_body_size=None,
+            body_class=None, cache=None, cache_timeout=None):
         '''pattern -- the regex that when matches calls handler
         handler -- the method to call when pattern matches
         accepts -- the content type that is accepted
@@ -44,27 +65,767 @@ class Route(object):
         has_payload -- if the request contains information on the body
         transform_body -- if accepts is JSON then call the method in this
             attribute and use the returned value as parameter to the method that
-            handles the request
+            handles the request, if accepts is NDJSON it's called with
+            each record
+        max_body_size -- the maximum size in bytes of the body, if exceeded
+            413 is returned (None means no limit)
+        body_class -- a JsonClass, if not None the JSON objects in the body
+            are decoded straight into instances of it
+        cache -- a werkzeug.contrib.cache.BaseCache instance, if not None the
+            marshalled responses of the handler are stored there and returned
+            without calling the handler until they expire or are invalidated
+            with Handler.invalidate, if the handler was wrapped with
+            Handler.authorize the checks run before looking in the cache and
+            the responses are cached per Authorization and Cookie headers,
+            other wrappers that check the request are skipped on cache hits
+            so don't cache their routes
+        cache_timeout -- the time in seconds the responses are cached (None
+            means the default timeout of the cache)
         '''
 
         self.pattern = pattern
         self.regex = re.compile(pattern)
-        self.group_count = pattern.count('(')
+        self.group_count = self.regex.groups
         self.handler = handler
         self.accepts = accepts
         self.produces = produces
         self.has_payload = has_payload
         self.transform_body = transform_body
+        self.max_body_size = max_body_size
+        self.body_class = body_class
+        self.cache = cache
+        self.cache_timeout = cache_timeout
+        # the authorize_func of the Handler.authorize wrappers of handler
+        self.authorizers = getattr(handler, 'tubes_authorizers', ())
+        # the last body returned by the handler and its etag, used to avoid
+        # hashing constant bodies on each request
+        self.last_etag = None
+        # encoding -> (body, compressed body) idem for compression
+        self.last_compressed = {}
+
+    def get_etag(self, body):
+        '''return a strong etag for body'''
+        last = self.last_etag
+
+        if last is not None and last[0] is body:
+            return last[1]
+
+        if isinstance(body, unicode):
+            etag = generate_etag(body.encode('utf-8'))
+        else:
+            etag = generate_etag(body)
+
+        self.last_etag = (body, etag)
+        return etag
+
+    def get_compressed(self, body, encoding, level=6):
+        '''return body compressed with encoding'''
+        last = self.last_compressed.get(encoding, None)
+
+        if last is not None and last[0] is body:
+            return last[1]
+
+        data = compress(body, encoding, level)
+        self.last_compressed[encoding] = (body, data)
+        return data
+
+    def cache_key(self, method, path, query_string='', variant=''):
+        '''return the key used to cache the response to a request, variant
+        tells apart the responses to the same request for different clients
+        '''
+        key = '%s %s?%s %s %s' % (method, path, query_string, self.produces,
+                variant)
+        return 'tubes/' + hashlib.md5(key).hexdigest()
+
+    def is_authorized(self, request):
+        '''return True if the request passes the Handler.authorize checks of
+        the handler'''
+        for authorize_func in self.authorizers:
+            if not authorize_func(request):
+                return False
+
+        return True
+
+    def version_key(self, method):
+        '''return the key of the version of the cached responses of the route
+        for method'''
+        key = '%s %s %s version' % (method, self.pattern, self.produces)
+        return 'tubes/' + hashlib.md5(key).hexdigest()
+
+    def request_cache_key(self, method, path, query_string, environ):
+        '''return the key used to cache the response to the request in
+        environ, the key includes a version of the route stored in the cache
+        so Handler.invalidate drops the responses to every path and query of
+        the route by changing it, if the handler is authorized the key
+        includes the credentials of the client too'''
+        version_key = self.version_key(method)
+        version = self.cache.get(version_key)
+
+        if version is None:
+            self.cache.add(version_key, os.urandom(8).encode('hex'))
+            version = self.cache.get(version_key) or ''
+
+        if self.authorizers:
+            variant = '%s\n%s\n%s' % (version,
+                    environ.get('HTTP_AUTHORIZATION', ''),
+                    environ.get('HTTP_COOKIE', ''))
+        else:
+            variant = version
+
+        return self.cache_key(method, path, query_string, variant)
+
+    def invalidate(self, method):
+        '''drop the cached responses of the route for method'''
+        self.cache.delete(self.version_key(method))
+
+    def get_args(self, match, offset=0):
+        '''return the positional arguments for the handler from a match
+        object, offset is the index of the group that precedes the first
+        group of this route (used when the match comes from a RouteMatcher)
+        '''
+        if self.group_count == 0:
+            return []
+        elif self.group_count == 1:
+            return [match.group(offset + 1)]
+        else:
+            return list(match.group(*range(offset + 1,
+                offset + self.group_count + 1)))
+
+class RouteMatcher(object):
+    '''match a path against a list of routes keeping the first match wins
+    semantics but doing one regex call for a group of routes instead of
+    one per route
+
+    the routes are compiled into chunks of alternations where each route is
+    wrapped in a capturing group, the group that matched is found with
+    match.lastindex, routes that can't be combined (backreferences,
+    conditional groups, named groups, inline flags or too many groups) are
+    matched alone
+    '''
+    # python 2 regexes can't have more than 100 groups
+    MAX_GROUPS = 100
+
+    def __init__(self):
+        self.routes = []
+        # a list of [regex, start, end, indexes] where indexes maps
+        # the wrapper group index to (route position, group offset)
+        self.chunks = []
+
+    def add(self, route):
+        '''add a route at the end of the matcher, only the last chunk is
+        recompiled'''
+        position = len(self.routes)
+        self.routes.append(route)
+
+        if not self._can_combine(route):
+            self.chunks.append([route.regex, position, position + 1, None])
+            return
+
+        if self.chunks:
+            last = self.chunks[-1]
+
+            if last[3] is not None and last[2] == position:
+                groups = sum(1 + item.regex.groups
+                        for item in self.routes[last[1]:position])
+
+                if groups + 1 + route.regex.groups <= self.MAX_GROUPS:
+                    chunk = self._compile(last[1], position + 1)
+
+                    if chunk is not None:
+                        self.chunks[-1] = chunk
+                        return
+
+        self.chunks.append(self._compile(position, position + 1))
+
+    def _can_combine(self, route):
+        '''return True if the route can be part of an alternation'''
+        if route.regex.groupindex or 1 + route.regex.groups > self.MAX_GROUPS:
+            return False
+
+        # inline flags like (?i) apply to the whole regex in python 2 so
+        # they would leak into the other routes of the chunk, group
+        # references like (?(1)...) would point to the groups of others
+        return re.search(r'\\[1-9]|\(\?P=|\(\?[iLmsux]|\(\?\(',
+                route.pattern) is None
+
+    def _compile(self, start, end):
+        '''return a chunk that matches the routes from start to end'''
+        parts = []
+        indexes = {}
+        group = 1
+
+        for position in range(start, end):
+            route = self.routes[position]
+            parts.append('(' + route.pattern + ')')
+            indexes[group] = (position, group)
+            group += 1 + route.regex.groups
+
+        try:
+            return [re.compile('|'.join(parts)), start, end, indexes]
+        except (re.error, AssertionError, OverflowError):
+            if end - start == 1:
+                return [self.routes[start].regex, start, end, None]
+
+            return None
+
+    def iter_matches(self, path):
+        '''yield (route, args) for every route that matches path in the
+        order the routes were added'''
+        routes = self.routes
+
+        for regex, start, end, indexes in self.chunks:
+            match = regex.match(path)
+
+            if match is None:
+                continue
+
+            if indexes is None:
+                route = routes[start]
+                yield route, route.get_args(match)
+                continue
+
+            position, offset = indexes[match.lastindex]
+            route = routes[position]
+            yield route, route.get_args(match, offset)
+
+            # only reached if the caller rejected the route, look for
+            # the following matches in this chunk one by one
+            for route in routes[position + 1:end]:
+                match = route.regex.match(path)
+
+                if match is not None:
+                    yield route, route.get_args(match)
+
+class LazyRequest(object):
+    '''a request facade that creates the werkzeug Request the first time
+    one of its attributes is accessed, requests that are never read by the
+    handler don't pay the cost of building and parsing it
+    '''
+    __slots__ = ('environ', '_request')
+
+    def __init__(self, environ):
+        '''environ -- the WSGI environment of the request'''
+        object.__setattr__(self, 'environ', environ)
+        object.__setattr__(self, '_request', None)
+
+    def get_request(self):
+        '''return the werkzeug Request, create it if needed'''
+        request = self._request
+
+        if request is None:
+            request = Request(self.environ)
+            object.__setattr__(self, '_request', request)
+
+        return request
+
+    def __getattr__(self, name):
+        return getattr(self.get_request(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_request(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self.get_request(), name)
+
+class Negotiator(object):
+    '''memoize the content negotiation of the requests
+
+    for each distinct raw Accept header a table that maps every mimetype
+    accepted by a registered route to True or False is built once, later
+    requests with the same header do a dict lookup
+    '''
+
+    def __init__(self, max_entries=256):
+        '''max_entries -- the number of Accept headers to remember, when
+            reached the cache is emptied
+        '''
+        self.max_entries = max_entries
+        self.mimetypes = set()
+        self.cache = {}
+        self.encodings = {}
+
+    def add(self, mimetype):
+        '''add a mimetype that a route accepts'''
+        if mimetype and mimetype not in self.mimetypes:
+            self.mimetypes.add(mimetype)
+            self.cache.clear()
+
+    def accepts(self, header, mimetype):
+        '''return True if a route that accepts mimetype can handle a request
+        with header as Accept header'''
+        if not mimetype:
+            return True
+
+        table = self.cache.get(header, None)
+
+        if table is None:
+            table = self.negotiate(header)
+
+        return table[mimetype]
+
+    def negotiate(self, header):
+        '''build and cache the table for header'''
+        accept = parse_accept_header(header, MIMEAccept)
+        values = accept.values()
+        any_type = not accept or '*/*' in values
+        table = dict((mimetype, any_type or mimetype in values)
+                for mimetype in self.mimetypes)
+
+        if len(self.cache) >= self.max_entries:
+            self.cache.clear()
+
+        self.cache[header] = table
+        return table
+
+    def encoding(self, header):
+        '''return the content encoding to use for a request with header as
+        Accept-Encoding header, 'gzip', 'deflate' or None'''
+        try:
+            return self.encodings[header]
+        except KeyError:
+            pass
+
+        accept = parse_accept_header(header)
+        encoding = None
+
+        for name in COMPRESSORS:
+            if accept[name] > 0:
+                encoding = name
+                break
+
+        if len(self.encodings) >= self.max_entries:
+            self.encodings.clear()
+
+        self.encodings[header] = encoding
+        return encoding
+
+# default path of the manifest of the static assets
+ASSETS_MANIFEST = 'assets.json'
+# one year, the maximum recommended by RFC 2616
+ASSETS_MAX_AGE = 365 * 24 * 60 * 60
+
+def build_assets(static_paths, manifest_path=ASSETS_MANIFEST, min_size=256,
+        compress_level=9):
+    '''content hash all the files on static_paths (a dict like
+    Handler.static_paths), write a .gz sibling for the files of at least
+    min_size bytes that get smaller when compressed and write a JSON manifest
+    to manifest_path (if not None), return the manifest
+
+    the manifest maps the url of each file to a dict with the fingerprinted
+    url, the path of the file, the path of the gzipped file (or None), the
+    etag and the mimetype
+    '''
+    manifest = {}
+
+    for match_path, dest_path in static_paths.iteritems():
+        match_path = match_path.rstrip('/')
+
+        if os.path.isfile(dest_path):
+            files = [(match_path, dest_path)]
+        else:
+            files = []
+
+            for root, dirs, names in os.walk(dest_path):
+                dirs.sort()
+
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    relpath = os.path.relpath(path, dest_path)
+                    url = match_path + '/' + '/'.join(relpath.split(os.sep))
+                    files.append((url, path))
+
+        for url, path in files:
+            if path.endswith('.gz'):
+                continue
+
+            data = open(path, 'rb').read()
+            digest = hashlib.md5(data).hexdigest()
+            base, ext = os.path.splitext(url)
+            gzip_path = None
+
+            if len(data) >= min_size:
+                gzipped = compress(data, 'gzip', compress_level)
+
+                if len(gzipped) < len(data):
+                    gzip_path = path + '.gz'
+                    gzip_file = open(gzip_path, 'wb')
+
+                    try:
+                        gzip_file.write(gzipped)
+                    finally:
+                        gzip_file.close()
+
+            manifest[url] = {
+                'url': '%s.%s%s' % (base, digest[:12], ext),
+                'path': path,
+                'gzip': gzip_path,
+                'etag': digest,
+                'mimetype': mimetypes.guess_type(path)[0] or BIN}
+
+    if manifest_path is not None:
+        manifest_file = open(manifest_path, 'w')
+
+        try:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        finally:
+            manifest_file.close()
+
+    return manifest
+
+def load_assets(manifest_path=ASSETS_MANIFEST):
+    '''return the manifest written by build_assets'''
+    manifest_file = open(manifest_path)
+
+    try:
+        return json.load(manifest_file)
+    finally:
+        manifest_file.close()
+
+class AssetMiddleware(object):
+    '''WSGI middleware that serves the fingerprinted urls of a manifest built
+    with build_assets as immutable files, using the precompressed file when
+    the client accepts gzip, other requests are passed to app
+    '''
+
+    def __init__(self, app, manifest, max_age=ASSETS_MAX_AGE):
+        '''app -- the WSGI application to wrap
+        manifest -- the dict returned by build_assets or load_assets
+        max_age -- the time in seconds the clients can cache the files
+        '''
+        self.app = app
+        self.cache_control = 'public, max-age=%d, immutable' % (max_age, )
+        self.assets = dict((asset['url'], asset)
+                for asset in manifest.itervalues())
+
+    def __call__(self, environ, start_response):
+        asset = self.assets.get(environ.get('PATH_INFO', ''), None)
+
+        if asset is None:
+            return self.app(environ, start_response)
+
+        # the values of a loaded manifest are unicode, headers must be str
+        etag = str(asset['etag'])
+        path = asset['path']
+        headers = [('Cache-Control', self.cache_control),
+                ('Content-Type', str(asset['mimetype']))]
+
+        if asset['gzip'] is not None:
+            headers.append(('Vary', 'Accept-Encoding'))
+            accept = parse_accept_header(
+                    environ.get('HTTP_ACCEPT_ENCODING', None))
+
+            if accept['gzip'] > 0:
+                path = asset['gzip']
+                etag += '-gzip'
+                headers.append(('Content-Encoding', 'gzip'))
+
+        headers.append(('ETag', '"%s"' % (etag, )))
+
+        if not is_resource_modified(environ, etag):
+            start_response('304 Not Modified', headers)
+            return []
+
+        try:
+            asset_file = open(path, 'rb')
+        except IOError:
+            return self.app(environ, start_response)
+
+        headers.append(('Content-Length',
+            str(os.fstat(asset_file.fileno()).st_size)))
+        start_response('200 OK', headers)
+        return wrap_file(environ, asset_file)
+
+# upper bounds in seconds of the buckets of the latency histograms
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+        0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PHASES = ('dispatch', 'decode', 'handler', 'marshal', 'write')
+PROMETHEUS = 'text/plain; version=0.0.4'
+
+class RequestTimer(object):
+    '''measures the time spent in each phase of a request'''
+    __slots__ = ('route', 'last', 'phases')
+
+    def __init__(self):
+        self.route = None
+        self.last = time.time()
+        self.phases = {}
+
+    def mark(self, phase):
+        '''add the time since the last mark to phase'''
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+class _NullTimer(object):
+    '''a RequestTimer that doesn't measure anything'''
+    __slots__ = ()
+
+    route = property(lambda self: None, lambda self, value: None)
+
+    def mark(self, phase):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+class MeteredIterator(object):
+    '''wraps the iterable returned by a WSGI application to count the bytes
+    sent and record the request in metrics when it's closed'''
+
+    def __init__(self, metrics, environ, app_iter, timer, status):
+        self.metrics = metrics
+        self.environ = environ
+        self.app_iter = app_iter
+        self.timer = timer
+        self.status = status
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+        self.timer.mark('write')
+        route = self.timer.route
+
+        if route is None:
+            pattern = 'unmatched'
+        else:
+            pattern = route.pattern
+
+        try:
+            size_in = int(self.environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            size_in = 0
+
+        self.metrics.record(pattern, self.environ.get('REQUEST_METHOD', ''),
+                self.status and self.status[0] or '', self.timer.phases,
+                size_in, self.size)
+
+class Metrics(object):
+    '''request counts, latency histograms per phase and bytes in and out per
+    route pattern, method and status
+
+    if directory is not None the stats of each process are saved there every
+    save_interval seconds and render aggregates the stats of all the
+    processes, use it when running with more than one process
+    '''
+
+    def __init__(self, directory=None, save_interval=1,
+            buckets=METRICS_BUCKETS):
+        self.directory = directory
+        self.save_interval = save_interval
+        self.buckets = buckets
+        # (pattern, method, status) -> [requests, bytes in, bytes out,
+        #   {phase: [count per bucket..., count over the last bucket, sum]}]
+        self.stats = {}
+        self.last_saved = 0
+        self.lock = threading.Lock()
+
+    def measure(self, environ, start_response, app, timer):
+        '''call the WSGI application app and return its response wrapped
+        so the request is recorded when it's finished'''
+        status = []
+
+        def start(status_line, headers, exc_info=None):
+            status[:] = [status_line[:3]]
+            return start_response(status_line, headers, exc_info)
+
+        return MeteredIterator(self, environ, app(environ, start), timer,
+                status)
+
+    def record(self, pattern, method, status, phases, size_in, size_out):
+        '''add a finished request to the stats'''
+        key = (pattern, method, status)
+        buckets = self.buckets
+        save = False
+
+        self.lock.acquire()
+        try:
+            stats = self.stats.get(key, None)
+
+            if stats is None:
+                stats = self.stats[key] = [0, 0, 0, {}]
+
+            stats[0] += 1
+            stats[1] += size_in
+            stats[2] += size_out
+
+            for phase, duration in phases.iteritems():
+                histogram = stats[3].get(phase, None)
+
+                if histogram is None:
+                    histogram = stats[3][phase] = [0] * (len(buckets) + 2)
+
+                histogram[bisect.bisect_left(buckets, duration)] += 1
+                histogram[-1] += duration
+
+            # checked under the lock so only one thread saves per interval
+            now = time.time()
+
+            if self.directory is not None and \
+                    now - self.last_saved >= self.save_interval:
+                self.last_saved = now
+                save = True
+        finally:
+            self.lock.release()
+
+        if save:
+            self.save()
+
+    def get_path(self, pid=None):
+        '''return the path where the stats of process pid are saved'''
+        return os.path.join(self.directory,
+                'metrics-%d.json' % (pid or os.getpid()))
+
+    def save(self):
+        '''save the stats of this process to directory'''
+        self.lock.acquire()
+        try:
+            self.last_saved = time.time()
+            data = json.dumps([list(key) + [stats]
+                for key, stats in self.stats.iteritems()])
+        finally:
+            self.lock.release()
+
+        path = self.get_path()
+        # a temporary file per thread so concurrent saves don't rename each
+        # other's file
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                threading.current_thread().ident)
+        handle = open(tmp_path, 'w')
+
+        try:
+            handle.write(data)
+        finally:
+            handle.close()
+
+        os.rename(tmp_path, path)
+
+    def merged(self):
+        '''return the stats of this process merged with the ones saved by the
+        other processes'''
+        self.lock.acquire()
+        try:
+            merged = dict((key, [stats[0], stats[1], stats[2],
+                dict((phase, list(histogram))
+                    for phase, histogram in stats[3].iteritems())])
+                for key, stats in self.stats.iteritems())
+        finally:
+            self.lock.release()
+
+        if self.directory is None:
+            return merged
+
+        own = self.get_path()
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            if not name.startswith('metrics-') or not name.endswith('.json') \
+                    or path == own:
+                continue
+
+            try:
+                handle = open(path)
+
+                try:
+                    saved = json.load(handle)
+                finally:
+                    handle.close()
+            except (IOError, ValueError):
+                continue
+
+            for pattern, method, status, stats in saved:
+                key = (pattern, method, status)
+                current = merged.get(key, None)
+
+                if current is None:
+                    merged[key] = stats
+                    continue
+
+                current[0] += stats[0]
+                current[1] += stats[1]
+                current[2] += stats[2]
+
+                for phase, histogram in stats[3].iteritems():
+                    mine = current[3].get(phase, None)
+
+                    if mine is None:
+                        current[3][phase] = histogram
+                    else:
+                        current[3][phase] = [a + b
+                            for a, b in zip(mine, histogram)]
+
+        return merged
+
+    def render(self):
+        '''return the stats in the prometheus text format'''
+        stats = self.merged()
+        keys = sorted(stats)
+        labels = dict((key, 'route="%s",method="%s",status="%s"' %
+            tuple(_escape_label(value) for value in key)) for key in keys)
+        lines = []
+
+        for index, name, doc in ((0, 'tubes_requests_total',
+                'Requests handled.'),
+                (1, 'tubes_request_bytes_total', 'Bytes received in bodies.'),
+                (2, 'tubes_response_bytes_total', 'Bytes sent in bodies.')):
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s counter' % name)
+
+            for key in keys:
+                lines.append('%s{%s} %d' % (name, labels[key],
+                    stats[key][index]))
+
+        name = 'tubes_request_phase_seconds'
+        lines.append('# HELP %s Time spent in each phase of the requests.' %
+                name)
+        lines.append('# TYPE %s histogram' % name)
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+
+        for key in keys:
+            histograms = stats[key][3]
+
+            for phase in METRICS_PHASES:
+                histogram = histograms.get(phase, None)
+
+                if histogram is None:
+                    continue
+
+                phase_labels = '%s,phase="%s"' % (labels[key], phase)
+                count = 0
+
+                for bound, bucket in zip(bounds, histogram):
+                    count += bucket
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name,
+                        phase_labels, bound, count))
+
+                lines.append('%s_sum{%s} %r' % (name, phase_labels,
+                    histogram[-1]))
+                lines.append('%s_count{%s} %d' % (name, phase_labels, count))
+
+        return '\n'.join(lines) + '\n'
+
+def _escape_label(value):
+    '''escape value to be used as a label value in the prometheus format'''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+            '\\n')
 
 def generate_route_decorator(method):
     '''return a decorator that will add Route objects to method'''
     def decorator(self, pattern, accepts=None, produces=JSON, has_payload=False,
-            transform_body=None):
+            transform_body=None, max_body_size=None, body_class=None,
+            cache=None, cache_timeout=None):
         '''the decorator to register a new Route'''
         def wrapper(func):
             '''the decorator itself'''
             self.register_route(method, pattern, func, accepts, produces,
-                    has_payload, transform_body)
+                    has_payload, transform_body, max_body_size, body_class,
+                    cache, cache_timeout)
             return func
         return wrapper
     return decorator
@@ -75,66 +836,236 @@ class Handler(object):
 
     def __init__(self):
         self.routes = {}
+        self.matchers = {}
+        self.negotiator = Negotiator()
         self.marshallers = {JSON: json.dumps}
         self.static_paths = {}
+        # the manifest of the fingerprinted static assets, see build_assets
+        self.assets = {}
+        # approximate size in bytes of the chunks sent when streaming
+        self.stream_chunk_size = 16 * 1024
+        # if True an etag is added to marshalled responses and conditional
+        # requests are answered with 304
+        self.use_etags = True
+        # marshalled responses of at least this size in bytes are compressed
+        # if the client accepts it (None disables compression)
+        self.compress_min_size = 1024
+        self.compress_level = 6
+        # a Metrics instance if metrics are enabled, see enable_metrics
+        self.metrics = None
+        # a SampledProfilerMiddleware wrapping the handler if profiling is
+        # enabled, see enable_profiling
+        self.profiler = None
 
     def __call__(self, environ, start_response):
         '''try to match the request with the registered routes'''
+        metrics = self.metrics
+
+        if metrics is None:
+            return self.dispatch(environ, NULL_TIMER)(environ, start_response)
+
+        timer = RequestTimer()
+        response = self.dispatch(environ, timer)
+        timer.mark('marshal')
+        return metrics.measure(environ, start_response, response, timer)
+
+    def dispatch(self, environ, timer):
+        '''return the WSGI application that answers the request, the time
+        spent in each phase is added to timer'''
         path = environ.get('PATH_INFO', '')
         command = environ.get('REQUEST_METHOD', None)
-        request = Request(environ)
+        request = LazyRequest(environ)
+        accept = environ.get('HTTP_ACCEPT', None)
+        matcher = self.matchers.get(command, None)
 
-        for route in self.routes.get(command, ()):
-            accepts = request.accept_mimetypes.values()
-            if route.accepts and request.accept_mimetypes and \
-                    route.accepts not in accepts and  '*/*' not in accepts:
-                continue
+        if matcher is not None:
+            for route, args in matcher.iter_matches(path):
+                if not self.negotiator.accepts(accept, route.accepts):
+                    continue
 
-            match = route.regex.match(path)
+                timer.route = route
 
-            if match is not None:
-                if route.group_count == 0:
-                    args = []
-                elif route.group_count == 1:
-                    args = [match.group(1)]
-                else:
-                    args = match.group(*range(1, route.group_count + 1))
+                key = None
 
-                if route.accepts == JSON:
-                    data = json.loads(request.stream.read())
+                if route.cache is not None and route.is_authorized(request):
+                    key = route.request_cache_key(command, path,
+                            environ.get('QUERY_STRING', ''), environ)
+                    cached = route.cache.get(key)
 
-                    if route.transform_body is not None:
-                        data = route.transform_body(data)
+                    if cached is not None:
+                        timer.mark('dispatch')
+                        return self.make_response(environ, route, *cached)
 
-                    # add the body of the request as first parameter
-                    args.insert(0, data)
+                timer.mark('dispatch')
 
                 try:
+                    if route.accepts in DECODED_TYPES:
+                        # add the body of the request as first parameter
+                        args.insert(0, self.decode_body(request, route))
+                        timer.mark('decode')
+
                     result = route.handler(request, *args)
                 except Response, response:
                     return response
+                except RequestEntityTooLarge, error:
+                    return error
+                finally:
+                    timer.mark('handler')
 
                 if isinstance(result, werkzeug.BaseResponse):
-                    return result(environ, start_response)
+                    return result
 
                 if route.produces == JSON and is_json_class(result):
                     result = result.to_json_str()
+                elif route.produces == JSON and is_iterator(result):
+                    if request.accept_mimetypes[NDJSON] > \
+                            request.accept_mimetypes[JSON]:
+                        return Response(iter_json(result, True,
+                            self.stream_chunk_size), content_type=NDJSON)
+
+                    result = iter_json(result, False, self.stream_chunk_size)
                 elif route.produces in self.marshallers:
                     result = self.marshallers[route.produces](result)
 
-                return Response(result, content_type=route.produces)(environ,
-                        start_response)
+                if not isinstance(result, basestring):
+                    return Response(result, content_type=route.produces)
 
-        return Response(status=404)(environ, start_response)
+                if self.use_etags:
+                    etag = route.get_etag(result)
+                else:
+                    etag = None
+
+                if key is not None:
+                    if self.is_compressible(result):
+                        gzipped = compress(result, 'gzip', self.compress_level)
+                    else:
+                        gzipped = None
+
+                    route.cache.set(key, (result, etag, gzipped),
+                            route.cache_timeout)
+                else:
+                    gzipped = None
+
+                return self.make_response(environ, route, result, etag,
+                        gzipped)
+
+        timer.mark('dispatch')
+        return Response(status=404, headers={'Content-Length': '0'})
+
+    def is_compressible(self, body):
+        '''return True if body is big enough to be compressed'''
+        return self.compress_min_size is not None and \
+                len(body) >= self.compress_min_size
+
+    def make_response(self, environ, route, body, etag=None, gzipped=None):
+        '''return a Response for body, if etag is not None it's added to the
+        response and a 304 is returned if the client has the same version
+
+        the body is compressed if the client accepts it, gzipped is the body
+        already compressed with gzip if available
+        '''
+        if self.is_compressible(body):
+            encoding = self.negotiator.encoding(
+                    environ.get('HTTP_ACCEPT_ENCODING', None))
+        else:
+            encoding = None
+
+        if encoding is None:
+            data = body
+
+            if isinstance(data, unicode):
+                data = data.encode(Response.charset)
+        else:
+            if encoding == 'gzip' and gzipped is not None:
+                data = gzipped
+            else:
+                data = route.get_compressed(body, encoding,
+                        self.compress_level)
+
+        # a known length lets the server keep the connection open
+        response = Response(data, content_type=route.produces,
+                headers={'Content-Length': str(len(data))})
+
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+
+            if etag is not None:
+                etag = etag + '-' + encoding
+
+        if self.is_compressible(body):
+            response.headers['Vary'] = 'Accept-Encoding'
+
+        if etag is not None:
+            response.set_etag(etag)
+            response.make_conditional(environ)
+
+        return response
+
+    def decode_body(self, request, route):
+        '''return the decoded body of a request to a route that accepts JSON
+        or an iterator of records if it accepts NDJSON, raise
+        RequestEntityTooLarge if the body exceeds route.max_body_size
+        '''
+        max_size = route.max_body_size
+        length = request.content_length
+
+        if max_size is not None and length is not None and length > max_size:
+            raise RequestEntityTooLarge()
+
+        if route.body_class is None:
+            decode = json.loads
+        else:
+            decode = route.body_class.TUBES_DECODER.decode
+
+        if route.accepts == NDJSON:
+            return iter_ndjson(request.stream, length or 0, max_size,
+                    route.transform_body, decode)
+
+        if max_size is None:
+            body = request.stream.read()
+        else:
+            body = request.stream.read(max_size + 1)
+
+            if len(body) > max_size:
+                raise RequestEntityTooLarge()
+
+        data = decode(body)
+
+        if route.transform_body is not None:
+            data = route.transform_body(data)
+
+        return data
 
     def register_route(self, method, pattern, handler, accepts, produces,
-            has_payload, transform_body):
+            has_payload, transform_body, max_body_size=None, body_class=None,
+            cache=None, cache_timeout=None):
         '''register a new route on the routes class variable'''
         if method not in self.routes:
             self.routes[method] = []
+            self.matchers[method] = RouteMatcher()
+
+        route = Route(pattern, handler, accepts, produces, has_payload,
+                transform_body, max_body_size, body_class, cache,
+                cache_timeout)
+        self.routes[method].append(route)
+        self.matchers[method].add(route)
+        self.negotiator.add(accepts)
+
+    def invalidate(self, path, method='GET'):
+        '''remove the cached responses of the route that handles path from
+        its cache (for every path and query string the route matches), return
+        True if a cached route was found'''
+        matcher = self.matchers.get(method, None)
 
-        self.routes[method].append(Route(pattern, handler, accepts, produces,
-            has_payload, transform_body))
+        if matcher is None:
+            return False
+
+        for route, args in matcher.iter_matches(path):
+            if route.cache is not None:
+                route.invalidate(method)
+                return True
+
+        return False
 
     def register_marshaller(self, mimetype, func):
         '''register a method to transform an input to an output accourding
@@ -145,6 +1076,70 @@ class Handler(object):
         '''register a path that will be served as static content'''
         self.static_paths[match_path] = os.path.join(*dest_path)
 
+    def build_assets(self, manifest_path=ASSETS_MANIFEST):
+        '''fingerprint and precompress the files on the static paths and write
+        the manifest to manifest_path, see build_assets'''
+        self.assets = build_assets(self.static_paths, manifest_path)
+        return self.assets
+
+    def load_assets(self, manifest_path=ASSETS_MANIFEST):
+        '''load the manifest written by build_assets, the fingerprinted urls
+        are served by run and run_gae from now on'''
+        self.assets = load_assets(manifest_path)
+        return self.assets
+
+    def asset_url(self, path):
+        '''return the fingerprinted url of the static file at path or path
+        if it isn't on the loaded manifest'''
+        asset = self.assets.get(path, None)
+
+        if asset is None:
+            return path
+
+        return asset['url']
+
+    def enable_metrics(self, pattern='^/metrics$', directory=None):
+        '''record the count, latency per phase and bytes in and out of the
+        requests per route and serve them on pattern in the prometheus text
+        format, if running more than one process pass a directory writable
+        by all of them to aggregate their stats, see Metrics'''
+        self.metrics = Metrics(directory)
+        self.register_route('GET', pattern, self.render_metrics, None,
+                PROMETHEUS, False, None)
+        return self.metrics
+
+    def render_metrics(self, request):
+        '''handler that returns the recorded metrics'''
+        return self.metrics.render()
+
+    def route_pattern(self, environ):
+        '''return the pattern of the first route that matches the path of the
+        request in environ or 'unmatched' if none matches, so unknown paths
+        share one key like they do in Metrics'''
+        path = environ.get('PATH_INFO', '')
+        matcher = self.matchers.get(environ.get('REQUEST_METHOD', None), None)
+
+        if matcher is not None:
+            for route, args in matcher.iter_matches(path):
+                return route.pattern
+
+        return 'unmatched'
+
+    def enable_profiling(self, sample_rate=100, slow_threshold=None,
+            path='/_profile'):
+        '''profile one in sample_rate requests, or only the ones slower than
+        slow_threshold seconds if it's not None, and serve the top functions
+        per route pattern on path (None to not serve them, the report is
+        answered before the routes are matched so path must not be one of
+        them), run and run_gae serve the handler through
+        the profiler from now on, see
+        werkzeug.contrib.profiler.SampledProfilerMiddleware'''
+        from werkzeug.contrib.profiler import SampledProfilerMiddleware
+
+        self.profiler = SampledProfilerMiddleware(self, sample_rate,
+                slow_threshold, self.route_pattern, path=path)
+        return self.profiler
+
     def authorize(self, authorize_func):
         '''decorator to validate a request prior to calling the handler
         if the authorize_func returns True, them the function is called
@@ -158,6 +1153,9 @@ class Handler(object):
                 else:
                     return Response("unauthorized", 401)
 
+            # lets routes with a cache check the request before using it
+            inner.tubes_authorizers = getattr(func, 'tubes_authorizers',
+                    ()) + (authorize_func, )
             return inner
         return wrapper
 
@@ -176,7 +1174,8 @@ class JsonClass(object):
     '''
 
     def __init__(self, to_ignore=None, from_ignore=None,
-            to_transform=None, from_transform=None, exclude_private_fields=True):
+            to_transform=None, from_transform=None, exclude_private_fields=True,
+            fields=None, slots=False, naming=None):
         '''constructor
 
         to_ignore -- a list of attributes to ignore when transforming to json
@@ -187,6 +1186,17 @@ class JsonClass(object):
             marshaling
         from_transform -- idem to to_trasnform but used with input values to
             transform
+        fields -- if not None a list of the attribute names of the class,
+            enables the strict mode where specialized to_json and from_json
+            methods are generated for the class and only these attributes are
+            read and written
+        slots -- if True the class is rebuilt with __slots__ set to fields or
+            if fields is None to the arguments of the constructor, instances
+            of the returned class don't have a __dict__
+        naming -- a naming policy for the attributes without a transform,
+            a tuple with the function that converts an attribute name to a
+            JSON name and the one that does the oposite (see CAMELCASE), the
+            names are converted once per class and cached
         '''
         self.to_ignore = to_ignore
 
@@ -209,22 +1219,41 @@ class JsonClass(object):
             self.from_transform = {}
 
         self.exclude_private_fields = exclude_private_fields
+        self.fields = fields
+        self.slots = slots
+        self.naming = naming
 
     def __call__(self, cls):
         '''the decorator, add constants to the class:
             * cls.TUBES_JSON_SERIALIZABLE = True
         and class methods:
          * cls.from_json()
+         * cls.from_json_pairs()
          * cls.from_json_str()
+         * cls.from_json_list()
+         * cls.from_json_list_str()
         and instance methods:
          * cls.to_json()
          * cls.to_json_str()
+
+        if slots is True a new class with __slots__ is returned
         '''
         if hasattr(cls, 'TUBES_JSON_SERIALIZABLE'):
             return cls
 
+        if self.slots:
+            names = self.fields
+
+            if names is None:
+                names = inspect.getargspec(cls.__init__)[0][1:]
+
+            cls = make_slotted(cls, names)
+
         setattr(cls, 'from_json', classmethod(from_json))
+        setattr(cls, 'from_json_pairs', classmethod(from_json_pairs))
         setattr(cls, 'from_json_str', classmethod(from_json_str))
+        setattr(cls, 'from_json_list', classmethod(from_json_list))
+        setattr(cls, 'from_json_list_str', classmethod(from_json_list_str))
         setattr(cls, 'to_json', to_json)
         setattr(cls, 'to_json_str', to_json_str)
         setattr(cls, 'to_json_list', classmethod(to_json_list))
@@ -236,32 +1265,425 @@ class JsonClass(object):
         setattr(cls, 'TUBES_FROM_TRANSFORM', self.from_transform)
         setattr(cls, 'TUBES_EXCLUDE_PRIVATE_FIELDS',
                 self.exclude_private_fields)
+        setattr(cls, 'TUBES_NAMING', self.naming)
+        # name -> action caches filled on use by to_json and from_json
+        setattr(cls, 'TUBES_TO_PLAN', {})
+        setattr(cls, 'TUBES_FROM_PLAN', {})
+        setattr(cls, 'TUBES_SLOTS', slot_names(cls))
+        setattr(cls, 'TUBES_FIELDS', None)
+        setattr(cls, 'TUBES_DECODER', make_decoder(cls))
+
+        if self.fields is not None:
+            self.generate_methods(cls)
 
         return cls
 
+    def generate_methods(self, cls):
+        '''generate the to_json and from_json methods for cls with the fields,
+        ignores and transforms resolved so the generated code only reads
+        and writes the attributes
+        '''
+        fields = tuple(self.fields)
+
+        for name in fields:
+            if _IDENTIFIER_RE.match(name) is None:
+                raise ValueError('invalid field name %r' % (name, ))
+
+        namespace = {'FIELDS': frozenset(fields)}
+        plain = []
+        lines = ['def to_json(self):']
+
+        for name in fields:
+            if name in self.to_ignore or (self.exclude_private_fields and
+                    name.startswith('_')):
+                continue
+
+            if name in self.to_transform:
+                transform = 'to_transform_%d' % (len(namespace), )
+                namespace[transform] = self.to_transform[name]
+                lines.append('    name, value = %s(%r, self.%s)' % (transform,
+                    name, name))
+                lines.append('    result[name] = value')
+            elif self.naming is not None:
+                plain.append('%r: self.%s' % (self.naming[0](name), name))
+            else:
+                plain.append('%r: self.%s' % (name, name))
+
+        lines.insert(1, '    result = {%s}' % (', '.join(plain), ))
+        lines.append('    return result')
+        to_json_method = _compile_function('to_json', lines, namespace)
+
+        lines = ['def from_json(cls, obj, instance=None):',
+                '    if instance is None:', '        instance = cls()']
+        names = list(fields) + [name for name in self.from_transform
+                if name not in fields]
+
+        for name in names:
+            if name in self.from_ignore:
+                continue
+
+            if name in self.from_transform or self.naming is None:
+                key = name
+            else:
+                key = self.naming[0](name)
+
+            lines.append('    if %r in obj:' % (key, ))
+
+            if name in self.from_transform:
+                transform = 'from_transform_%d' % (len(namespace), )
+                namespace[transform] = self.from_transform[name]
+                lines.append('        name, value = %s(%r, obj[%r])' % (
+                    transform, name, name))
+                lines.append('        if name in FIELDS:')
+                lines.append('            setattr(instance, name, value)')
+            else:
+                lines.append('        instance.%s = obj[%r]' % (name, key))
+
+        lines.append('    return instance')
+        from_json_method = _compile_function('from_json', lines, namespace)
+
+        setattr(cls, 'from_json', classmethod(from_json_method))
+        setattr(cls, 'to_json', to_json_method)
+        setattr(cls, 'TUBES_FIELDS', frozenset(fields))
+
+def make_slotted(cls, names):
+    '''return a copy of cls with __slots__ set to names'''
+    attrs = dict(cls.__dict__)
+
+    for name in names:
+        if name in attrs:
+            raise ValueError('%r in slots conflicts with class attribute' % (
+                name, ))
+
+    attrs.pop('__dict__', None)
+    attrs.pop('__weakref__', None)
+    attrs['__slots__'] = tuple(names)
+
+    return type(cls)(cls.__name__, cls.__bases__, attrs)
+
+def slot_names(cls):
+    '''return a tuple with the names of the slots defined on cls and its
+    bases, private names are returned mangled'''
+    names = []
+
+    for klass in reversed(inspect.getmro(cls)):
+        slots = vars(klass).get('__slots__', ())
+
+        if isinstance(slots, basestring):
+            slots = (slots, )
+
+        for name in slots:
+            if name in ('__dict__', '__weakref__'):
+                continue
+
+            if name.startswith('__') and not name.endswith('__'):
+                name = '_%s%s' % (klass.__name__.lstrip('_'), name)
+
+            if name not in names:
+                names.append(name)
+
+    return tuple(names)
+
+def _class_slots(cls):
+    '''return the slot names of cls, cached on cls as TUBES_SLOTS, the value
+    inherited from a base is ignored since a subclass may add its own slots
+    '''
+    slots = vars(cls).get('TUBES_SLOTS', None)
+
+    if slots is None:
+        slots = slot_names(cls)
+        setattr(cls, 'TUBES_SLOTS', slots)
+
+    return slots
+
+def _clone(obj, slots):
+    '''return a copy of obj without calling its constructor, the values of
+    the attributes are shallow copies so mutable defaults like lists aren't
+    shared between the clones'''
+    cls = obj.__class__
+    clone = cls.__new__(cls)
+    copy_value = copy.copy
+
+    for name in slots:
+        try:
+            setattr(clone, name, copy_value(getattr(obj, name)))
+        except AttributeError:
+            pass
+
+    if hasattr(obj, '__dict__'):
+        clone.__dict__.update((name, copy_value(value))
+                for name, value in obj.__dict__.iteritems())
+
+    return clone
+
+def _iter_fields(obj, slots):
+    '''return a list of (name, value) with the attributes of obj stored in
+    slots and in its __dict__ if it has one'''
+    fields = []
+
+    for name in slots:
+        try:
+            fields.append((name, getattr(obj, name)))
+        except AttributeError:
+            pass
+
+    if hasattr(obj, '__dict__'):
+        fields.extend(vars(obj).iteritems())
+
+    return fields
+
+_IDENTIFIER_RE = re.compile('^[A-Za-z_][A-Za-z0-9_]*$')
+
+# action used in the TUBES_TO_PLAN and TUBES_FROM_PLAN caches
+_IGNORE = object()
+# number of names remembered per class by the TUBES_TO_PLAN and
+# TUBES_FROM_PLAN caches, the names come from the request bodies
+PLAN_CACHE_SIZE = 256
+
+def _compile_function(name, lines, namespace):
+    '''compile the code in lines and return the function called name
+    defined in it'''
+    exec '\n'.join(lines) + '\n' in namespace
+    return namespace[name]
+
+def _to_json_action(cls, name):
+    '''return and cache the action to take for the attribute name on to_json,
+    _IGNORE, None to copy the value or the transform to call'''
+    if name in cls.TUBES_TO_IGNORE:
+        action = _IGNORE
+    elif cls.TUBES_EXCLUDE_PRIVATE_FIELDS and name.startswith('_'):
+        action = _IGNORE
+    elif name in cls.TUBES_TO_TRANSFORM:
+        action = cls.TUBES_TO_TRANSFORM[name]
+    elif cls.TUBES_NAMING is not None:
+        action = _renamer(cls.TUBES_NAMING[0](name))
+    else:
+        action = None
+
+    if len(cls.TUBES_TO_PLAN) >= PLAN_CACHE_SIZE:
+        cls.TUBES_TO_PLAN.clear()
+
+    cls.TUBES_TO_PLAN[name] = action
+    return action
+
+def _from_json_action(cls, name):
+    '''return and cache the action to take for the key name on from_json,
+    _IGNORE, None to copy the value or the transform to call'''
+    if name in cls.TUBES_FROM_IGNORE:
+        action = _IGNORE
+    elif name in cls.TUBES_FROM_TRANSFORM:
+        action = cls.TUBES_FROM_TRANSFORM[name]
+    elif cls.TUBES_NAMING is not None:
+        action = _renamer(cls.TUBES_NAMING[1](name))
+    else:
+        action = None
+
+    if len(cls.TUBES_FROM_PLAN) >= PLAN_CACHE_SIZE:
+        cls.TUBES_FROM_PLAN.clear()
+
+    cls.TUBES_FROM_PLAN[name] = action
+    return action
+
+def _renamer(new_name):
+    '''return a transform that replaces the name with new_name'''
+    def rename(name, value):
+        '''the transform'''
+        return new_name, value
+
+    return rename
+
+def iter_ndjson(stream, limit, max_size=None, transform=None,
+        decode=json.loads, buffer_size=16 * 1024):
+    '''yield the records of a newline delimited JSON stream one by one,
+    raise RequestEntityTooLarge when more than max_size bytes are read
+
+    limit -- the number of bytes that can be read from stream if it isn't
+        a LimitedStream (usually the content length)
+    transform -- if not None it's called with each record and the returned
+        value is yielded instead
+    decode -- the function used to decode each line
+    buffer_size -- the size of the reads, records can be longer
+    '''
+    if not isinstance(stream, LimitedStream):
+        stream = LimitedStream(stream, limit)
+
+    size = 0
+    # the pieces of the line that is being read
+    pending = []
+    done = False
+
+    while not done:
+        chunk = stream.read(buffer_size)
+
+        if chunk:
+            size += len(chunk)
+
+            if max_size is not None and size > max_size:
+                raise RequestEntityTooLarge()
+
+            lines = chunk.split('\n')
+            pending.append(lines[0])
+
+            if len(lines) == 1:
+                continue
+
+            lines[0] = ''.join(pending)
+            pending = [lines.pop()]
+        else:
+            lines = [''.join(pending)]
+            done = True
+
+        for line in lines:
+            line = line.strip()
+
+            if not line:
+                continue
+
+            record = decode(line)
+
+            if transform is not None:
+                record = transform(record)
+
+            yield record
+
+def iter_json(items, ndjson=False, chunk_size=16 * 1024):
+    '''yield a JSON array (or newline delimited JSON if ndjson is True) with
+    the values from items encoding them as they are produced, the output is
+    yielded in chunks of at least chunk_size bytes (except the last one)
+    '''
+    encoder = json.JSONEncoder()
+    chunk = []
+    size = 0
+
+    if not ndjson:
+        chunk.append('[')
+
+    first = True
+
+    for item in items:
+        if is_json_class(item):
+            item = item.to_json()
+
+        if first:
+            first = False
+        elif not ndjson:
+            chunk.append(',')
+
+        for part in encoder.iterencode(item):
+            chunk.append(part)
+            size += len(part)
+
+        if ndjson:
+            chunk.append('\n')
+
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+
+    if not ndjson:
+        chunk.append(']')
+
+    yield ''.join(chunk)
+
+# the supported content encodings in order of preference
+COMPRESSORS = ('gzip', 'deflate')
+
+def compress(body, encoding, level=6):
+    '''return body compressed with encoding ('gzip' or 'deflate')'''
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(level)
+
+    return compressor.compress(body) + compressor.flush()
+
+def is_iterator(obj):
+    '''return True if obj is an iterator (a generator for example)'''
+    return hasattr(obj, 'next') and hasattr(obj, '__iter__')
+
 def is_json_class(cls):
     '''return True if cls is a json class
     '''
     return hasattr(cls, 'TUBES_JSON_SERIALIZABLE')
 
-def from_json(cls, obj):
+# json.loads of python 2.7 can build objects from the key value pairs
+# without creating a dict first
+_HAS_PAIRS_HOOK = 'object_pairs_hook' in \
+        inspect.getargspec(json.JSONDecoder.__init__)[0]
+
+def make_decoder(cls):
+    '''return a JSONDecoder that decodes every JSON object as an instance
+    of cls'''
+    if _HAS_PAIRS_HOOK:
+        return json.JSONDecoder(object_pairs_hook=cls.from_json_pairs)
+
+    return json.JSONDecoder(object_hook=cls.from_json)
+
+def from_json(cls, obj, instance=None):
     '''return a class instance taking the values from the json obj and
-    transforming according to from_transform
+    transforming according to from_transform, if instance is given the
+    values are set on it instead of on a new instance
+    '''
+    return cls.from_json_pairs(obj.iteritems(), instance)
+
+def from_json_pairs(cls, pairs, instance=None):
+    '''idem to from_json but taking the values from an iterable of
+    (name, value) tuples
     '''
-    instance = cls()
+    if instance is None:
+        instance = cls()
 
-    for name, value in obj.iteritems():
-        if name in cls.TUBES_FROM_IGNORE:
-            continue
+    plan = cls.TUBES_FROM_PLAN
+    fields = cls.TUBES_FIELDS
 
-        if name in cls.TUBES_FROM_TRANSFORM:
-            name, value = cls.TUBES_FROM_TRANSFORM[name](name, value)
+    for name, value in pairs:
+        try:
+            action = plan[name]
+        except KeyError:
+            action = _from_json_action(cls, name)
 
-        if hasattr(instance, name):
+        if action is not None:
+            if action is _IGNORE:
+                continue
+
+            name, value = action(name, value)
+
+        if fields is None:
+            if hasattr(instance, name):
+                setattr(instance, name, value)
+        elif name in fields:
             setattr(instance, name, value)
 
     return instance
 
+def from_json_list(cls, objs, call_init=True):
+    '''return a list of class instances from a list of json objects, if
+    call_init is False the constructor is called only once and the other
+    instances are copies of that one where each attribute is copied with
+    copy.copy, values nested in a mutable default are still shared
+    '''
+    from_json_method = cls.from_json
+
+    if call_init:
+        return [from_json_method(obj) for obj in objs]
+
+    prototype = cls()
+    slots = _class_slots(cls)
+
+    return [from_json_method(obj, _clone(prototype, slots)) for obj in objs]
+
+def from_json_list_str(cls, objs_str):
+    '''return a list of class instances from a json str, the instances are
+    built by the decoder so no intermediate dicts are kept, all the objects
+    in the string (nested ones included) are decoded as instances of cls
+    '''
+    return cls.TUBES_DECODER.decode(objs_str)
+
 def from_json_str(cls, obj_str):
     '''return a class instance taking the values from the json str and
     transforming according to from_transform
@@ -271,20 +1693,30 @@ def from_json_str(cls, obj_str):
 def to_json(self):
     '''return a json representation of the object
     '''
-    fields = []
-    for name, value in vars(self).iteritems():
-        if name in self.TUBES_TO_IGNORE:
-            continue
-
-        if self.TUBES_EXCLUDE_PRIVATE_FIELDS and name.startswith('_'):
-            continue
+    result = {}
+    plan = self.TUBES_TO_PLAN
+    slots = _class_slots(self.__class__)
+
+    if slots:
+        fields = _iter_fields(self, slots)
+    else:
+        fields = vars(self).iteritems()
+
+    for name, value in fields:
+        try:
+            action = plan[name]
+        except KeyError:
+            action = _to_json_action(self.__class__, name)
+
+        if action is not None:
+            if action is _IGNORE:
+                continue
 
-        if name in self.TUBES_TO_TRANSFORM:
-            name, value = self.TUBES_TO_TRANSFORM[name](name, value)
+            name, value = action(name, value)
 
-        fields.append((name, value))
+        result[name] = value
 
-    return dict(fields)
+    return result
 
 def to_json_str(self):
     '''return a json string representation of the object
@@ -301,6 +1733,14 @@ def to_json_list_str(cls, objs):
     '''
     return json.dumps(cls.to_json_list(objs))
 
+_UNDERSCORE_RE = re.compile('\_([a-z])')
+_CAMELCASE_RE = re.compile('([a-z])([A-Z])')
+
+# number of names remembered by the name conversion functions
+NAME_CACHE_SIZE = 1024
+_camelcase_names = {}
+_underscore_names = {}
+
 def _replace_underscore_to_camelcase(match):
     '''function used in underscores_to_camelcase to replace the match
     '''
@@ -314,14 +1754,36 @@ def _replace_camelcase_to_underscore(match):
 def underscores_to_camelcase(name):
     '''replace all the underscores followed by a a to z letter to camelcase
     '''
-    return re.sub('\_([a-z])', _replace_underscore_to_camelcase, name)
+    try:
+        return _camelcase_names[name]
+    except KeyError:
+        pass
+
+    result = _UNDERSCORE_RE.sub(_replace_underscore_to_camelcase, name)
+
+    if len(_camelcase_names) >= NAME_CACHE_SIZE:
+        _camelcase_names.clear()
+
+    _camelcase_names[name] = result
+    return result
 
 def camelcase_to_underscores(name):
     '''replace all the [a-z] followed by [A-Z] to underscores
     when something like a_b_c_d is replaced to aBCD the oposite wont be a_b_c_d
     but a_bC_d
     '''
-    return re.sub('([a-z])([A-Z])', _replace_camelcase_to_underscore, name)
+    try:
+        return _underscore_names[name]
+    except KeyError:
+        pass
+
+    result = _CAMELCASE_RE.sub(_replace_camelcase_to_underscore, name)
+
+    if len(_underscore_names) >= NAME_CACHE_SIZE:
+        _underscore_names.clear()
+
+    _underscore_names[name] = result
+    return result
 
 def c2u(name, value):
     '''utility function to be used when transforming to or from JSON
@@ -333,21 +1795,60 @@ def u2c(name, value):
     '''
     return underscores_to_camelcase(name), value
 
+# naming policy for JsonClass, attributes with underscores and camelcase JSON
+CAMELCASE = (underscores_to_camelcase, camelcase_to_underscores)
+
 def run(handler, host='0.0.0.0', port=8000, use_reloader=False,
         use_debugger=False, use_evalex=True, extra_files=None,
         reloader_interval=1, threaded=False, processes=1, request_handler=None,
-        passthrough_errors=False):
-    '''create a server instance and run it'''
-    werkzeug.run_simple(host, port, handler, use_reloader, use_debugger,
+        passthrough_errors=False, prefork=False, max_requests=None,
+        pool_size=None, queue_size=None, event_loop=False):
+    '''create a server instance and run it
+
+    if prefork is True and processes is greater than 1 the application is
+    loaded once and served by processes long-lived workers, each one is
+    replaced after max_requests requests if max_requests is not None
+
+    if threaded is True and pool_size is set the requests are handled by a
+    fixed pool of threads, connections that don't fit in a queue of
+    queue_size entries are answered with a 503
+
+    if event_loop is True see run_async
+    '''
+    app = handler.profiler or handler
+
+    if handler.assets:
+        app = AssetMiddleware(app, handler.assets)
+
+    werkzeug.run_simple(host, port, app, use_reloader, use_debugger,
             use_evalex, extra_files, reloader_interval, threaded, processes,
-            request_handler, handler.static_paths, passthrough_errors)
+            request_handler, handler.static_paths, passthrough_errors,
+            prefork, max_requests, pool_size, queue_size, event_loop)
+
+def run_async(handler, host='0.0.0.0', port=8000, pool_size=10,
+        queue_size=None, **kwargs):
+    '''create a server that handles the connections in an event loop and
+    run it
+
+    reading requests and writing responses doesn't use a thread so idle and
+    slow clients are cheap, the handlers run in a pool of pool_size threads
+    and requests that don't fit in a queue of queue_size entries are
+    answered with a 503, the rest of the arguments are the same as in run
+    '''
+    run(handler, host, port, pool_size=pool_size, queue_size=queue_size,
+            event_loop=True, **kwargs)
 
 def run_gae(handler):
     '''run the application on google app engine'''
+    app = handler.profiler or handler
+
+    if handler.assets:
+        app = AssetMiddleware(app, handler.assets)
+
     if handler.static_paths:
         from werkzeug.utils import SharedDataMiddleware
-        handler = SharedDataMiddleware(handler, handler.static_paths)
+        app = SharedDataMiddleware(app, handler.static_paths)
 
     from google.appengine.ext.webapp.util import run_wsgi_app
-    run_wsgi_app(handler)
+    run_wsgi_app(app)
 
@@ -13,10 +13,22 @@
         from werkzeug.contrib.profiler import ProfilerMiddleware
         app = ProfilerMiddleware(app)
 
+    To profile under real traffic use the :class:`SampledProfilerMiddleware`
+    which profiles only some of the requests and aggregates the stats::
+
+        from werkzeug.contrib.profiler import SampledProfilerMiddleware
+        app = SampledProfilerMiddleware(app, sample_rate=100,
+                                        path='/_profile')
+
     :copyright: (c) 2009 by the Werkzeug Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
 import sys
+import time
+from itertools import count
+from threading import Lock
+from cStringIO import StringIO
+from werkzeug.utils import url_decode
 try:
     try:
         from cProfile import Profile
@@ -98,6 +110,188 @@ class ProfilerMiddleware(object):
         return [body]
 
 
+class _StatsCopy(object):
+    """Looks like a profile to `Stats` to create a copy of a `Stats`."""
+
+    def __init__(self, stats):
+        self.stats = dict(stats.stats)
+
+    def create_stats(self):
+        pass
+
+
+class SampledProfilerMiddleware(object):
+    """A profiler middleware that is cheap enough to run in production.
+    Only one in `sample_rate` requests is profiled and the stats are
+    aggregated per key instead of being printed.  The key of a request is
+    returned by `key_func` which is called with the WSGI environment before
+    the application runs, it defaults to the path of the request.
+
+    If `slow_threshold` is set only the profiles of requests that took at
+    least that many seconds are kept.  The requests that aren't profiled are
+    timed and if one of them is slow the next request with the same key is
+    profiled even if it isn't sampled.
+
+    If `path` is given requests to it are answered with the merged top
+    functions as plain text instead of being passed to the application.
+    The report accepts the arguments `key` to show only the stats of one
+    key, `sort` and `limit`.
+
+    :param app: the WSGI application to profile.
+    :param sample_rate: profile one in this many requests.
+    :param slow_threshold: the minimum time in seconds of the requests whose
+                           profiles are kept or `None`.
+    :param key_func: a function that returns the key of a request.
+    :param sort_by: a tuple of columns to sort the report by.
+    :param limit: the number of functions shown in the report.
+    :param path: the path the report is served on or `None`.
+    """
+
+    def __init__(self, app, sample_rate=100, slow_threshold=None,
+                 key_func=None, sort_by=('cumulative', 'time'), limit=30,
+                 path=None):
+        if not available:
+            raise RuntimeError('the profiler is not available because '
+                               'profile or pstat is not installed.')
+        self._app = app
+        self.sample_rate = max(int(sample_rate), 1)
+        self.slow_threshold = slow_threshold
+        self.key_func = key_func or (lambda environ:
+                                     environ.get('PATH_INFO', ''))
+        self.sort_by = sort_by
+        self.limit = limit
+        self.path = path
+        # key -> [number of profiled requests, Stats]
+        self.stats = {}
+        # keys of which the next request is profiled
+        self.armed = set()
+        self._counter = count(1)
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        if self.path is not None and environ.get('PATH_INFO') == self.path:
+            return self.serve_report(environ, start_response)
+
+        key = None
+        sampled = self._counter.next() % self.sample_rate == 0
+        if not sampled and self.armed:
+            key = self.key_func(environ)
+            if key in self.armed:
+                self.armed.discard(key)
+                sampled = True
+
+        if not sampled:
+            if self.slow_threshold is None:
+                return self._app(environ, start_response)
+            started = time.time()
+            appiter = self._app(environ, start_response)
+            if time.time() - started >= self.slow_threshold:
+                self.armed.add(self.key_func(environ))
+            return appiter
+
+        if key is None:
+            key = self.key_func(environ)
+        return self.profile(key, environ, start_response)
+
+    def profile(self, key, environ, start_response):
+        """Profile a request and add its stats to the ones of `key`.  The
+        response is passed on chunk by chunk, only the call of the
+        application and the iteration of its response are profiled.
+        """
+        p = Profile()
+        elapsed = [0]
+
+        def run(func, *args):
+            started = time.time()
+            try:
+                return p.runcall(func, *args)
+            finally:
+                elapsed[0] += time.time() - started
+
+        appiter = run(self._app, environ, start_response)
+        return self._iter_profiled(key, p, run, elapsed, appiter)
+
+    def _iter_profiled(self, key, p, run, elapsed, appiter):
+        try:
+            iterator = run(iter, appiter)
+            while 1:
+                try:
+                    chunk = run(iterator.next)
+                except StopIteration:
+                    break
+                yield chunk
+        finally:
+            if hasattr(appiter, 'close'):
+                run(appiter.close)
+            if self.slow_threshold is None or \
+               elapsed[0] >= self.slow_threshold:
+                self._add_stats(key, Stats(p, stream=sys.stderr))
+
+    def _add_stats(self, key, stats):
+        self._lock.acquire()
+        try:
+            current = self.stats.get(key)
+            if current is None:
+                self.stats[key] = [1, stats]
+            else:
+                current[0] += 1
+                current[1].add(stats)
+        finally:
+            self._lock.release()
+
+    def report(self, key=None, sort_by=None, limit=None):
+        """Return the top functions of the profiled requests of `key` or
+        of all the requests if `key` is `None` as text.
+        """
+        stream = StringIO()
+        self._lock.acquire()
+        try:
+            if key is None:
+                keys = sorted(self.stats)
+            else:
+                keys = [key]
+            keys = [x for x in keys if x in self.stats]
+            for x in keys:
+                stream.write('%s: %d profiled requests\n' %
+                             (x, self.stats[x][0]))
+            if not keys:
+                stream.write('no profiled requests\n')
+                return stream.getvalue()
+            # `Stats` can't be created empty or copied from another one but
+            # it loads anything with a `create_stats` method like a profile
+            first = _StatsCopy(self.stats[keys[0]][1])
+            merged = Stats(first, stream=stream)
+            merged.add(*[self.stats[x][1] for x in keys[1:]])
+        finally:
+            self._lock.release()
+        merged.sort_stats(*(sort_by or self.sort_by))
+        merged.print_stats(limit or self.limit)
+        return stream.getvalue()
+
+    def clear(self):
+        """Throw away the collected stats."""
+        self._lock.acquire()
+        try:
+            self.stats.clear()
+            self.armed.clear()
+        finally:
+            self._lock.release()
+
+    def serve_report(self, environ, start_response):
+        args = url_decode(environ.get('QUERY_STRING', ''))
+        try:
+            limit = int(args.get('limit', self.limit))
+        except ValueError:
+            limit = self.limit
+        sort_by = args.get('sort') and args['sort'].split(',') or None
+        body = self.report(args.get('key'), sort_by, limit)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+
 def make_action(app_factory, hostname='localhost', port=5000,
                 threaded=False, processes=1, stream=None,
                 sort_by=('time', 'calls'), restrictions=()):
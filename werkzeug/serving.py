@@ -42,36 +42,103 @@
     :license: BSD, see LICENSE for more details.
 """
 import os
+import errno
+import select
+import asyncore
+import mimetools
+import signal
 import socket
 import sys
 import time
 import thread
+import threading
 import subprocess
+from Queue import Queue, Full
 from urllib import unquote
 from urlparse import urlparse
 from itertools import chain
+from collections import deque
+from cStringIO import StringIO
+from traceback import format_exception
 from SocketServer import ThreadingMixIn, ForkingMixIn
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 from werkzeug import __version__ as version
 from werkzeug._internal import _log
-from werkzeug.utils import responder
+from werkzeug.utils import responder, http_date, FileWrapper, LimitedStream
 from werkzeug.exceptions import InternalServerError
 
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            import ctypes.util
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+            _libc.sendfile64.argtypes = (ctypes.c_int, ctypes.c_int,
+                                         ctypes.POINTER(ctypes.c_int64),
+                                         ctypes.c_size_t)
+            _libc.sendfile64.restype = ctypes.c_ssize_t
+
+            def sendfile(out_fd, in_fd, offset, count):
+                """Minimal `os.sendfile` for Pythons that don't have it."""
+                offset = ctypes.c_int64(offset)
+                sent = _libc.sendfile64(out_fd, in_fd, ctypes.byref(offset),
+                                        count)
+                if sent == -1:
+                    code = ctypes.get_errno()
+                    raise OSError(code, os.strerror(code))
+                return sent
+        except (ImportError, OSError, AttributeError):
+            sendfile = None
+
+# Python 2 doesn't define the constant even on Linux where it exists
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if _SO_REUSEPORT is None and sys.platform.startswith('linux'):
+    _SO_REUSEPORT = 15
+
 
 class BaseRequestHandler(BaseHTTPRequestHandler, object):
     server_version = 'Werkzeug/' + version
+    protocol_version = 'HTTP/1.1'
+    # buffer the status line and the headers and send them without delay
+    # together with the body, small writes on a persistent connection would
+    # otherwise wait for the delayed ACKs of the client
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # seconds a persistent connection may stay idle between two requests
+    keep_alive_timeout = 5
+    # number of requests served on a connection before it's closed
+    max_keep_alive_requests = 100
+    # unread request bodies bigger than this close the connection instead
+    # of being read and thrown away
+    max_drain_size = 64 * 1024
 
     def make_environ(self):
         path_info, query = urlparse(self.path)[2::2]
+        try:
+            content_length = max(int(self.headers['Content-Length']), 0)
+        except (KeyError, ValueError):
+            content_length = 0
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            # the end of the body can't be found so the connection can't
+            # be reused
+            self.close_connection = True
+            self.input_stream = self.rfile
+        else:
+            self.input_stream = LimitedStream(self.rfile, content_length)
         environ = {
             'wsgi.version':         (1, 0),
             'wsgi.url_scheme':      'http',
-            'wsgi.input':           self.rfile,
+            'wsgi.input':           self.input_stream,
             'wsgi.errors':          sys.stderr,
             'wsgi.multithread':     self.server.multithread,
             'wsgi.multiprocess':    self.server.multiprocess,
             'wsgi.run_once':        False,
+            'wsgi.file_wrapper':    FileWrapper,
             'REQUEST_METHOD':       self.command,
             'SCRIPT_NAME':          '',
             'PATH_INFO':            unquote(path_info),
@@ -85,6 +152,10 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
             'SERVER_PROTOCOL':      self.request_version
         }
 
+        stats = getattr(self.server, 'stats', None)
+        if stats is not None:
+            environ['werkzeug.server.stats'] = stats
+
         for key, value in self.headers.items():
             key = 'HTTP_' + key.upper().replace('-', '_')
             if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
@@ -97,21 +168,46 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
         environ = self.make_environ()
         headers_set = []
         headers_sent = []
+        chunked = []
+        bodyless = []
 
         def write(data):
             assert headers_set, 'write() before start_response'
             if not headers_sent:
                 status, response_headers = headers_sent[:] = headers_set
                 code, msg = status.split(None, 1)
-                self.send_response(int(code), msg)
+                code = int(code)
+                if self.is_bodyless(code):
+                    bodyless.append(True)
+                self.send_response(code, msg)
                 header_keys = set()
                 for key, value in response_headers:
+                    lower = key.lower()
+                    if lower == 'connection':
+                        if value.lower() == 'close':
+                            self.close_connection = True
+                        continue
                     self.send_header(key, value)
-                    key = key.lower()
-                    header_keys.add(key)
-                if 'content-length' not in header_keys:
+                    header_keys.add(lower)
+                if 'content-length' not in header_keys and \
+                   'transfer-encoding' not in header_keys and \
+                   not self.is_bodyless(code):
+                    if self.request_version == 'HTTP/1.1':
+                        # the length is unknown, send the body in chunks
+                        # so the end can be found without closing
+                        chunked.append(True)
+                        self.send_header('Transfer-Encoding', 'chunked')
+                    else:
+                        self.close_connection = True
+                if not self.close_connection and \
+                   self.server.has_waiting_connections():
+                    # let the waiting connections in instead of serving the
+                    # next request of this one
                     self.close_connection = True
+                if self.close_connection:
                     self.send_header('Connection', 'close')
+                elif self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
                 if 'server' not in header_keys:
                     self.send_header('Server', self.version_string())
                 if 'date' not in header_keys:
@@ -119,7 +215,11 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
                 self.end_headers()
 
             assert type(data) is str, 'applications must write bytes'
-            self.wfile.write(data)
+            if data and not bodyless:
+                if chunked:
+                    self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    self.wfile.write(data)
             self.wfile.flush()
 
         def start_response(status, response_headers, exc_info=None):
@@ -137,11 +237,25 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
         def execute(app):
             application_iter = app(environ, start_response)
             try:
+                if headers_set and \
+                   self.is_bodyless(int(headers_set[0].split(None, 1)[0])):
+                    # the body is never sent, don't read it
+                    write('')
+                    return
+                if isinstance(application_iter, FileWrapper) and \
+                   sendfile is not None:
+                    # make sure the headers are sent before the file
+                    write('')
+                    if not chunked and self.send_file(application_iter):
+                        return
                 for data in application_iter:
                     write(data)
                 # make sure the headers are sent
                 if not headers_sent:
                     write('')
+                if chunked:
+                    self.wfile.write('0\r\n\r\n')
+                    self.wfile.flush()
             finally:
                 if hasattr(application_iter, 'close'):
                     application_iter.close()
@@ -150,8 +264,11 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
         try:
             execute(app)
         except (socket.error, socket.timeout), e:
+            self.close_connection = True
             self.connection_dropped(e, environ)
         except:
+            # the body may be cut short so the connection can't be reused
+            self.close_connection = True
             if self.server.passthrough_errors:
                 raise
             from werkzeug.debug.tbtools import get_current_traceback
@@ -167,18 +284,118 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
             self.server.log('error', 'Error on request:\n%s',
                             traceback.plaintext)
 
+    def send_file(self, wrapper):
+        """Send the file of a :class:`FileWrapper` with `sendfile` so the
+        data is copied by the kernel.  Returns `False` if the file has no
+        descriptor and must be sent by iterating over the wrapper.
+        """
+        try:
+            in_fd = wrapper.file.fileno()
+            offset = wrapper.file.tell()
+        except (AttributeError, IOError, ValueError):
+            return False
+        if wrapper.length is None:
+            remaining = os.fstat(in_fd).st_size - offset
+        else:
+            remaining = wrapper.length
+        out_fd = self.connection.fileno()
+        while remaining > 0:
+            try:
+                sent = sendfile(out_fd, in_fd, offset, remaining)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    select.select([], [out_fd], [])
+                    continue
+                raise socket.error(e.errno, e.strerror)
+            if not sent:
+                break
+            offset += sent
+            remaining -= sent
+        return True
+
     def connection_dropped(self, error, environ):
         """Called if the connection was closed by the client.  By default
         nothing happens.
         """
 
+    def is_bodyless(self, code):
+        """Return `True` if a response with this status code to the
+        current request never has a body.
+        """
+        return self.command == 'HEAD' or code < 200 or code in (204, 304)
+
+    def handle(self):
+        """Handle requests until the connection is closed."""
+        self.requests_handled = 0
+        self.input_stream = None
+        BaseHTTPRequestHandler.handle(self)
+
     def handle_one_request(self):
         """Handle a single HTTP request."""
-        self.raw_requestline = self.rfile.readline()
+        try:
+            if self.requests_handled and not self.wait_for_request():
+                self.close_connection = 1
+                return
+            self.raw_requestline = self.rfile.readline()
+        except socket.error:
+            # the client went away (e.g. reset an idle keep-alive
+            # connection) before sending a request
+            self.close_connection = 1
+            return
         if not self.raw_requestline:
             self.close_connection = 1
         elif self.parse_request():
-            return self.run_wsgi()
+            self.requests_handled += 1
+            if self.server.count_request() or \
+               self.requests_handled >= self.max_keep_alive_requests:
+                self.close_connection = 1
+            try:
+                return self.run_wsgi()
+            finally:
+                if not self.close_connection:
+                    self.finish_input()
+
+    def wait_for_request(self):
+        """Wait for the next request on a persistent connection.  Returns
+        `False` if the connection stays idle for `keep_alive_timeout` seconds
+        or if the server has other connections waiting that it can't handle
+        while this one is open.
+        """
+        buffered = getattr(self.rfile, '_rbuf', None)
+        if buffered is not None and buffered.tell():
+            # a pipelined request is already buffered
+            return True
+        deadline = time.time() + self.keep_alive_timeout
+        while 1:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                ready = select.select([self.connection], [], [],
+                                      min(remaining, 0.1))[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                return False
+            if ready:
+                return True
+            if self.server.has_waiting_connections():
+                return False
+
+    def finish_input(self):
+        """Read what the application left of the request body so the next
+        request on the connection can be parsed.
+        """
+        stream = self.input_stream
+        if not isinstance(stream, LimitedStream) or stream.is_exhausted:
+            return
+        if stream.limit - stream._pos > self.max_drain_size:
+            self.close_connection = 1
+            return
+        try:
+            stream.exhaust()
+        except (socket.error, socket.timeout):
+            self.close_connection = 1
 
     def send_response(self, code, message=None):
         """Send the response header and log the response code."""
@@ -199,6 +416,9 @@ class BaseRequestHandler(BaseHTTPRequestHandler, object):
 class BaseWSGIServer(HTTPServer):
     multithread = False
     multiprocess = False
+    # the listen backlog, connections beyond it are dropped and retried by
+    # the clients seconds later
+    request_queue_size = 128
 
     def __init__(self, host, port, app, handler=None,
                  passthrough_errors=False):
@@ -211,6 +431,22 @@ class BaseWSGIServer(HTTPServer):
     def log(self, type, message, *args):
         _log(type, message, *args)
 
+    def has_waiting_connections(self):
+        """Return `True` if connections are waiting to be accepted.  Idle
+        persistent connections are closed then so a server that handles
+        one connection at a time doesn't make the others wait.
+        """
+        try:
+            return bool(select.select([self.socket], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def count_request(self):
+        """Called by the request handler for every request it handles.
+        Returns `True` if the connection must be closed after the request.
+        """
+        return False
+
     def serve_forever(self):
         try:
             HTTPServer.serve_forever(self)
@@ -227,6 +463,109 @@ class BaseWSGIServer(HTTPServer):
 class ThreadedWSGIServer(ThreadingMixIn, BaseWSGIServer):
     multithread = True
 
+    def has_waiting_connections(self):
+        return False
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """A multithreaded server that handles the connections with a fixed
+    pool of `pool_size` threads.  Accepted connections wait in a queue of
+    at most `queue_size` entries, if the queue is full the connection is
+    answered with a ``503 Service Unavailable`` and a ``Retry-After``
+    header of `retry_after` seconds instead.
+
+    The current state of the pool is returned by :meth:`stats` which is
+    also available to the application as ``werkzeug.server.stats`` in the
+    WSGI environment.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, pool_size=10, handler=None,
+                 passthrough_errors=False, queue_size=None, retry_after=1):
+        BaseWSGIServer.__init__(self, host, port, app, handler,
+                                passthrough_errors)
+        if queue_size is None:
+            queue_size = pool_size * 4
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.queue = Queue(queue_size)
+        self.busy = 0
+        self.handled = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self.workers = []
+        for x in xrange(pool_size):
+            worker = threading.Thread(target=self.process_queue)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stats(self):
+        """Return a dict with the size of the pool, the number of busy
+        threads, the depth of the queue and the number of handled and
+        rejected connections.
+        """
+        return {
+            'pool_size':    self.pool_size,
+            'busy':         self.busy,
+            'queue_size':   self.queue_size,
+            'queue_depth':  self.queue.qsize(),
+            'handled':      self.handled,
+            'rejected':     self.rejected
+        }
+
+    def has_waiting_connections(self):
+        return self.queue.qsize() > 0
+
+    def process_request(self, request, client_address):
+        try:
+            self.queue.put_nowait((request, client_address))
+        except Full:
+            self._lock.acquire()
+            self.rejected += 1
+            self._lock.release()
+            self.reject_request(request, client_address)
+
+    def process_queue(self):
+        """The main loop of a thread of the pool."""
+        while 1:
+            request, client_address = self.queue.get()
+            self._lock.acquire()
+            self.busy += 1
+            self._lock.release()
+            try:
+                try:
+                    self.finish_request(request, client_address)
+                except:
+                    self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self._lock.acquire()
+                self.busy -= 1
+                self.handled += 1
+                self._lock.release()
+
+    def reject_request(self, request, client_address):
+        """Answer a connection that doesn't fit in the queue.  This runs
+        in the accepting thread so it never blocks.
+        """
+        body = 'Service Unavailable'
+        try:
+            request.settimeout(0.0)
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Retry-After: %d\r\n'
+                            'Content-Type: text/plain\r\n'
+                            'Content-Length: %d\r\n'
+                            'Connection: close\r\n\r\n%s' %
+                            (self.retry_after, len(body), body))
+            # read what already arrived so closing doesn't reset the
+            # connection before the client gets the response
+            request.recv(65536)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
 
 class ForkingWSGIServer(ForkingMixIn, BaseWSGIServer):
     multiprocess = True
@@ -237,18 +576,761 @@ class ForkingWSGIServer(ForkingMixIn, BaseWSGIServer):
                                 passthrough_errors)
         self.max_children = processes
 
+    def has_waiting_connections(self):
+        return False
+
+
+class PreforkWSGIServer(BaseWSGIServer):
+    """A server that loads the application once and forks `processes`
+    long-lived workers that accept connections on the socket of the master
+    process.  Workers that die are restarted and if `max_requests` is set
+    each worker exits after handling that many requests and is replaced by
+    a fresh one.
+
+    If `reuse_port` is `True` and ``SO_REUSEPORT`` is available each worker
+    listens on its own socket and the kernel balances the connections
+    between them.  The kernel resets the connections queued on the socket
+    of a worker that exits, so `max_requests` can't be used then, and other
+    processes can bind the same port without an error and take part of the
+    connections.
+    """
+    multiprocess = True
+    # seconds a worker waits for a connection before checking that its
+    # master is still alive
+    timeout = 1
+    # workers that fail faster than this are restarted after a pause
+    min_worker_lifetime = 1
+
+    def __init__(self, host, port, app, processes=4, handler=None,
+                 passthrough_errors=False, max_requests=None,
+                 reuse_port=False):
+        self.reuse_port = reuse_port and _SO_REUSEPORT is not None
+        if self.reuse_port and max_requests:
+            raise ValueError("cannot recycle workers that have their own "
+                             "socket.")
+        BaseWSGIServer.__init__(self, host, port, app, handler,
+                                passthrough_errors)
+        self.processes = processes
+        self.max_requests = max_requests
+        self.handled = 0
+        self.workers = {}
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        BaseWSGIServer.server_bind(self)
+
+    def count_request(self):
+        self.handled += 1
+        return bool(self.max_requests) and self.handled >= self.max_requests
+
+    def serve_forever(self):
+        master = os.getpid()
+        if self.reuse_port:
+            # the workers open their own sockets, connections queued on this
+            # one would never be accepted
+            self.socket.close()
+        try:
+            while 1:
+                while len(self.workers) < self.processes:
+                    self.spawn_worker(master)
+                pid, status = os.wait()
+                started = self.workers.pop(pid, None)
+                if started is None:
+                    continue
+                if status:
+                    self.log('error', 'worker %d died with status %d',
+                             pid, status)
+                    if time.time() - started < self.min_worker_lifetime:
+                        time.sleep(self.min_worker_lifetime)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_workers()
+
+    def spawn_worker(self, master):
+        """Fork a new worker."""
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+        code = 0
+        try:
+            try:
+                self.run_worker(master)
+            except KeyboardInterrupt:
+                pass
+            except:
+                from traceback import print_exc
+                print_exc()
+                code = 1
+        finally:
+            os._exit(code)
+
+    def run_worker(self, master):
+        """The main loop of a worker."""
+        self.workers = {}
+        self.handled = 0
+        if self.reuse_port:
+            self.socket = socket.socket(self.address_family,
+                                        self.socket_type)
+            self.server_bind()
+            self.server_activate()
+        while os.getppid() == master:
+            if self.max_requests and self.handled >= self.max_requests:
+                break
+            self.handle_request()
+        if self.reuse_port:
+            self.drain()
+
+    def drain(self):
+        """Handle the connections queued on the socket of this worker, they
+        are reset when the socket is closed.
+        """
+        while select.select([self.socket], [], [], 0)[0]:
+            self._handle_request_noblock()
+        self.socket.close()
+
+    def stop_workers(self):
+        """Terminate the workers and wait for them."""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+
+
+class _LoopTrigger(asyncore.dispatcher):
+    """Runs callbacks from other threads in the thread of the event loop of
+    an :class:`AsyncWSGIServer`.
+    """
+
+    def __init__(self, map):
+        reader, self._writer = socket.socketpair()
+        asyncore.dispatcher.__init__(self, reader, map)
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def writable(self):
+        return False
+
+    def call_soon(self, callback, *args):
+        self._lock.acquire()
+        try:
+            self._pending.append((callback, args))
+        finally:
+            self._lock.release()
+        try:
+            self._writer.send('x')
+        except socket.error:
+            pass
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except socket.error:
+            pass
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, []
+        finally:
+            self._lock.release()
+        for callback, args in pending:
+            callback(*args)
+
+
+class _AsyncListener(asyncore.dispatcher):
+    """Accepts the connections of an :class:`AsyncWSGIServer`."""
+
+    def __init__(self, server, host, port):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, int(port)))
+        self.listen(1024)
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _AsyncConnection(self.server, *pair)
+
+
+class _AsyncConnection(asyncore.dispatcher):
+    """A client connection of an :class:`AsyncWSGIServer`.  Requests are
+    read and responses written by the event loop, only the application
+    runs in the threads of the pool.
+    """
+
+    def __init__(self, server, sock, client_address):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            pass
+        self.server = server
+        self.client_address = client_address
+        self.in_buffer = ''
+        # how much of in_buffer was searched for the end of the headers
+        self.scanned = 0
+        # the request whose body is being read and the parts read so far
+        self.head = None
+        self.body = []
+        self.body_remaining = 0
+        self.out_buffer = deque()
+        # the bytes of the first piece of out_buffer that were sent
+        self.out_offset = 0
+        # when out_buffer was last sent from or stopped being empty
+        self.last_sent = time.time()
+        # the bytes queued for the connection and not sent yet, the pool
+        # waits on output_ready while there are too many
+        self.pending = 0
+        self.output_ready = threading.Condition(threading.Lock())
+        self.busy = False
+        self.close_when_done = False
+        # if True the input is read and thrown away until the client closes
+        # the connection, so it gets an error response sent before the end
+        # of its request instead of a reset
+        self.discard_input = False
+        self.requests_handled = 0
+        self.last_activity = time.time()
+
+    def readable(self):
+        return not self.busy and \
+            (not self.close_when_done or self.discard_input)
+
+    def writable(self):
+        return bool(self.out_buffer)
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            self.close()
+            return
+        if self.discard_input:
+            # last_activity isn't updated so the connection is closed
+            # once it has been idle for keep_alive_timeout anyway
+            return
+        self.last_activity = time.time()
+        if self.head is None:
+            self.in_buffer += data
+            self.parse_request()
+        else:
+            self.read_body(data)
+
+    def handle_write(self):
+        data = self.out_buffer[0]
+        if self.out_offset:
+            sent = self.send(buffer(data, self.out_offset))
+        else:
+            sent = self.send(data)
+        self.out_offset += sent
+        if sent:
+            self.last_sent = time.time()
+        if self.out_offset >= len(data):
+            self.out_buffer.popleft()
+            self.out_offset = 0
+        self.output_sent(sent)
+        self.last_activity = time.time()
+        if not self.out_buffer and not self.busy:
+            self.request_done()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.log('error', 'Error on connection:\n%s',
+                        ''.join(format_exception(*sys.exc_info())))
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        # wake up the thread of the pool that may wait to write
+        self.output_ready.acquire()
+        try:
+            self.output_ready.notifyAll()
+        finally:
+            self.output_ready.release()
+
+    def reserve_output(self, size):
+        """Wait until the connection has room for `size` more bytes of
+        output, called by the threads of the pool before pushing data.
+        """
+        self.output_ready.acquire()
+        try:
+            while self.connected and \
+                  self.pending > self.server.max_pending_output:
+                self.output_ready.wait(1)
+            if not self.connected:
+                raise socket.error(errno.EPIPE, 'connection closed')
+            self.pending += size
+        finally:
+            self.output_ready.release()
+
+    def output_sent(self, size):
+        self.output_ready.acquire()
+        try:
+            self.pending -= size
+            if self.pending <= self.server.max_pending_output:
+                self.output_ready.notifyAll()
+        finally:
+            self.output_ready.release()
+
+    def push(self, data, reserved=False):
+        """Queue data to be sent, called by the loop.  If `reserved` is
+        `False` the data wasn't counted by :meth:`reserve_output`.
+        """
+        if self.connected and data:
+            if not reserved:
+                self.output_ready.acquire()
+                self.pending += len(data)
+                self.output_ready.release()
+            if not self.out_buffer:
+                self.last_sent = time.time()
+            self.out_buffer.append(data)
+
+    def finish(self, keep_alive):
+        """Called when the application finished the current request."""
+        self.busy = False
+        if not keep_alive:
+            self.close_when_done = True
+        if self.connected and not self.out_buffer:
+            self.request_done()
+
+    def request_done(self):
+        if self.close_when_done and self.discard_input:
+            try:
+                self.socket.shutdown(socket.SHUT_WR)
+            except socket.error:
+                self.close()
+        elif self.close_when_done:
+            self.close()
+        elif self.in_buffer:
+            # a pipelined request
+            self.parse_request()
+
+    def send_error(self, code):
+        body = BaseHTTPRequestHandler.responses[code][0]
+        self.push('HTTP/1.0 %d %s\r\nContent-Type: text/plain\r\n'
+                  'Content-Length: %d\r\nConnection: close\r\n\r\n%s' %
+                  (code, body, len(body), body))
+        self.close_when_done = True
+        self.discard_input = True
+
+    def parse_request(self):
+        """Parse the headers of the next request in the input buffer."""
+        end = self.in_buffer.find('\r\n\r\n', max(self.scanned - 3, 0))
+        if end == -1:
+            self.scanned = len(self.in_buffer)
+            if self.scanned > self.server.max_header_size:
+                self.send_error(400)
+            return
+        lines = self.in_buffer[:end].split('\r\n', 1)
+        data = self.in_buffer[end + 4:]
+        self.in_buffer = ''
+        self.scanned = 0
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            self.send_error(400)
+            return
+        headers = mimetools.Message(StringIO(lines[1:] and lines[1] or ''),
+                                    0)
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            self.send_error(411)
+            return
+        try:
+            length = max(int(headers.get('Content-Length') or 0), 0)
+        except ValueError:
+            self.send_error(400)
+            return
+        if length > self.server.max_body_size:
+            self.send_error(413)
+            return
+        self.head = (lines[0], words, headers)
+        self.body = []
+        self.body_remaining = length
+        self.read_body(data)
+
+    def read_body(self, data):
+        """Add data to the body of the current request and submit the
+        request once it's complete.
+        """
+        if data:
+            part = data[:self.body_remaining]
+            self.body.append(part)
+            self.body_remaining -= len(part)
+            if len(part) < len(data):
+                # the start of a pipelined request
+                self.in_buffer = data[len(part):]
+        if self.body_remaining:
+            return
+        requestline, words, headers = self.head
+        body = ''.join(self.body)
+        self.head = None
+        self.body = []
+
+        connection = headers.get('Connection', '').lower()
+        if words[2] == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        self.requests_handled += 1
+        if self.requests_handled >= self.server.max_keep_alive_requests:
+            keep_alive = False
+        self.busy = True
+        request = (requestline, words[0], words[1], words[2], headers, body,
+                   keep_alive)
+        if not self.server.submit(self, request):
+            self.busy = False
+            self.server.reject_request(self)
+
+
+class AsyncWSGIServer(object):
+    """A server that handles the connections in an event loop and runs the
+    application in a fixed pool of `pool_size` threads.  Reading requests
+    and writing responses is done by the loop, so thousands of idle, slow
+    or persistent connections can be open at the same time.  A thread of
+    the pool only waits while a connection has `max_pending_output` bytes
+    not sent, connections that take none of them for `send_timeout` seconds
+    are closed.
+
+    Up to `queue_size` complete requests wait for a free thread, requests
+    beyond that are answered with a ``503 Service Unavailable`` and a
+    ``Retry-After`` header like :class:`PooledWSGIServer` does.
+    """
+    multithread = True
+    multiprocess = False
+    server_version = 'Werkzeug/' + version
+    # seconds a persistent connection may stay idle between two requests
+    keep_alive_timeout = 5
+    # number of requests served on a connection before it's closed
+    max_keep_alive_requests = 100
+    # connections sending request headers bigger than this are closed
+    max_header_size = 64 * 1024
+    # requests with a bigger body are answered with 413
+    max_body_size = 10 * 1024 * 1024
+    # the threads of the pool wait while a connection has more than this
+    # many bytes of output that weren't sent
+    max_pending_output = 256 * 1024
+    # seconds a connection may have output pending without taking any of
+    # it, then it's closed and the thread of the pool writing to it freed
+    send_timeout = 30
+    # seconds between two checks for idle connections
+    idle_check_interval = 1
+
+    def __init__(self, host, port, app, pool_size=10,
+                 passthrough_errors=False, queue_size=None, retry_after=1):
+        if queue_size is None:
+            queue_size = pool_size * 4
+        self.app = app
+        self.passthrough_errors = passthrough_errors
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.map = {}
+        self.listener = _AsyncListener(self, host, port)
+        self.server_address = self.listener.socket.getsockname()
+        self.trigger = _LoopTrigger(self.map)
+        self.queue = Queue(queue_size)
+        self.busy = 0
+        self.handled = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self.workers = []
+        for x in xrange(pool_size):
+            worker = threading.Thread(target=self.process_queue)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def log(self, type, message, *args):
+        _log(type, message, *args)
+
+    def stats(self):
+        """Return the state of the pool like :meth:`PooledWSGIServer.stats`
+        and the number of open connections.
+        """
+        return {
+            'pool_size':    self.pool_size,
+            'busy':         self.busy,
+            'queue_size':   self.queue_size,
+            'queue_depth':  self.queue.qsize(),
+            'handled':      self.handled,
+            'rejected':     self.rejected,
+            'connections':  len(self.map) - 2
+        }
+
+    def submit(self, connection, request):
+        """Queue a request for the pool.  Returns `False` if the queue is
+        full.
+        """
+        try:
+            self.queue.put_nowait((connection, request))
+        except Full:
+            return False
+        return True
+
+    def reject_request(self, connection):
+        self.rejected += 1
+        body = 'Service Unavailable'
+        connection.push('HTTP/1.0 503 Service Unavailable\r\n'
+                        'Retry-After: %d\r\n'
+                        'Content-Type: text/plain\r\n'
+                        'Content-Length: %d\r\n'
+                        'Connection: close\r\n\r\n%s' %
+                        (self.retry_after, len(body), body))
+        connection.close_when_done = True
+
+    def serve_forever(self):
+        use_poll = hasattr(select, 'poll')
+        next_check = time.time() + self.idle_check_interval
+        try:
+            while 1:
+                asyncore.loop(self.idle_check_interval, use_poll, self.map, 1)
+                if time.time() >= next_check:
+                    self.close_idle_connections()
+                    next_check = time.time() + self.idle_check_interval
+        except KeyboardInterrupt:
+            pass
+
+    def close_idle_connections(self):
+        """Close the connections that are idle for `keep_alive_timeout`
+        seconds and the ones that don't read their output for
+        `send_timeout` seconds.
+        """
+        now = time.time()
+        deadline = now - self.keep_alive_timeout
+        send_deadline = now - self.send_timeout
+        for connection in self.map.values():
+            if not isinstance(connection, _AsyncConnection):
+                continue
+            if connection.out_buffer:
+                if connection.last_sent < send_deadline:
+                    connection.close()
+            elif not connection.busy and \
+                 connection.last_activity < deadline:
+                connection.close()
+
+    def process_queue(self):
+        """The main loop of a thread of the pool."""
+        while 1:
+            connection, request = self.queue.get()
+            self._lock.acquire()
+            self.busy += 1
+            self._lock.release()
+            try:
+                keep_alive = False
+                try:
+                    keep_alive = self.run_wsgi(connection, request)
+                except:
+                    self.log('error', 'Error on request:\n%s',
+                             ''.join(format_exception(*sys.exc_info())))
+            finally:
+                self.trigger.call_soon(connection.finish, keep_alive)
+                self._lock.acquire()
+                self.busy -= 1
+                self.handled += 1
+                self._lock.release()
+
+    def make_environ(self, connection, request):
+        requestline, method, path, version, headers, body, keep_alive = \
+            request
+        path_info, query = urlparse(path)[2::2]
+        environ = {
+            'wsgi.version':         (1, 0),
+            'wsgi.url_scheme':      'http',
+            'wsgi.input':           StringIO(body),
+            'wsgi.errors':          sys.stderr,
+            'wsgi.multithread':     self.multithread,
+            'wsgi.multiprocess':    self.multiprocess,
+            'wsgi.run_once':        False,
+            'wsgi.file_wrapper':    FileWrapper,
+            'werkzeug.server.stats': self.stats,
+            'REQUEST_METHOD':       method,
+            'SCRIPT_NAME':          '',
+            'PATH_INFO':            unquote(path_info),
+            'QUERY_STRING':         query,
+            'CONTENT_TYPE':         headers.get('Content-Type', ''),
+            'CONTENT_LENGTH':       headers.get('Content-Length', ''),
+            'REMOTE_ADDR':          connection.client_address[0],
+            'REMOTE_PORT':          connection.client_address[1],
+            'SERVER_NAME':          self.server_address[0],
+            'SERVER_PORT':          str(self.server_address[1]),
+            'SERVER_PROTOCOL':      version
+        }
+
+        for key, value in headers.items():
+            key = 'HTTP_' + key.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = value
+
+        return environ
+
+    def run_wsgi(self, connection, request):
+        """Run the application for a request in a thread of the pool.  The
+        response is handed to the event loop as it's produced.  Returns
+        `True` if the connection can be reused.
+        """
+        requestline, method, path, version, headers, body, keep_alive = \
+            request
+        environ = self.make_environ(connection, request)
+        push = self.trigger.call_soon
+        headers_set = []
+        headers_sent = []
+        chunked = []
+        bodyless = []
+        state = {'keep_alive': keep_alive}
+
+        def is_bodyless(code):
+            return method == 'HEAD' or code < 200 or code in (204, 304)
+
+        def send(data):
+            connection.reserve_output(len(data))
+            push(connection.push, data, True)
+
+        def write(data):
+            assert headers_set, 'write() before start_response'
+            assert type(data) is str, 'applications must write bytes'
+            if data and not bodyless and headers_sent:
+                if chunked:
+                    data = '%x\r\n%s\r\n' % (len(data), data)
+                send(data)
+            elif not headers_sent:
+                status, response_headers = headers_sent[:] = headers_set
+                code = int(status.split(None, 1)[0])
+                if is_bodyless(code):
+                    bodyless.append(True)
+                self.log('info', '%s - - [%s] "%s" %s -',
+                         connection.client_address[0],
+                         time.strftime('%d/%b/%Y %H:%M:%S'), requestline,
+                         code)
+                lines = ['%s %s' % (version, status)]
+                header_keys = set()
+                for key, value in response_headers:
+                    lower = key.lower()
+                    if lower == 'connection':
+                        if value.lower() == 'close':
+                            state['keep_alive'] = False
+                        continue
+                    lines.append('%s: %s' % (key, value))
+                    header_keys.add(lower)
+                if 'content-length' not in header_keys and \
+                   'transfer-encoding' not in header_keys and \
+                   not bodyless:
+                    if version == 'HTTP/1.1':
+                        chunked.append(True)
+                        lines.append('Transfer-Encoding: chunked')
+                    else:
+                        state['keep_alive'] = False
+                if not state['keep_alive']:
+                    lines.append('Connection: close')
+                elif version == 'HTTP/1.0':
+                    lines.append('Connection: keep-alive')
+                if 'server' not in header_keys:
+                    lines.append('Server: ' + self.server_version)
+                if 'date' not in header_keys:
+                    lines.append('Date: %s' % http_date())
+                head = '\r\n'.join(lines) + '\r\n\r\n'
+                # the headers and the first part of the body are sent
+                # together
+                if data and not bodyless:
+                    if chunked:
+                        data = '%x\r\n%s\r\n' % (len(data), data)
+                    head += data
+                send(head)
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info:
+                try:
+                    if headers_sent:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            elif headers_set:
+                raise AssertionError('Headers already set')
+            headers_set[:] = [status, response_headers]
+            return write
+
+        def execute(app):
+            application_iter = app(environ, start_response)
+            try:
+                if headers_set and \
+                   is_bodyless(int(headers_set[0].split(None, 1)[0])):
+                    # the body is never sent, don't read it
+                    write('')
+                    return
+                for data in application_iter:
+                    write(data)
+                if not headers_sent:
+                    write('')
+                if chunked:
+                    send('0\r\n\r\n')
+            finally:
+                if hasattr(application_iter, 'close'):
+                    application_iter.close()
+                application_iter = None
+
+        try:
+            execute(self.app)
+        except socket.error:
+            # the connection was closed
+            state['keep_alive'] = False
+        except:
+            if self.passthrough_errors:
+                raise
+            traceback = ''.join(format_exception(*sys.exc_info()))
+            state['keep_alive'] = False
+            try:
+                if not headers_sent:
+                    del headers_set[:]
+                    execute(InternalServerError())
+            except:
+                pass
+            self.log('error', 'Error on request:\n%s', traceback)
+        return state['keep_alive']
+
 
 def make_server(host, port, app=None, threaded=False, processes=1,
-                request_handler=None, passthrough_errors=False):
+                request_handler=None, passthrough_errors=False,
+                prefork=False, max_requests=None, pool_size=None,
+                queue_size=None, event_loop=False):
     """Create a new server instance that is either threaded, or forks
     or just processes one request after another.
+
+    If `prefork` is `True` and `processes` is greater than one a
+    :class:`PreforkWSGIServer` is used instead of forking per request.  If
+    `threaded` is `True` and a `pool_size` is given a
+    :class:`PooledWSGIServer` is used instead of a thread per request.  If
+    `event_loop` is `True` an :class:`AsyncWSGIServer` with a pool of
+    `pool_size` threads is used.
     """
-    if threaded and processes > 1:
+    if event_loop:
+        if processes > 1:
+            raise ValueError("cannot have an event loop and "
+                             "multi process server.")
+        return AsyncWSGIServer(host, port, app, pool_size or 10,
+                               passthrough_errors, queue_size)
+    elif threaded and processes > 1:
         raise ValueError("cannot have a multithreaded and "
                          "multi process server.")
+    elif threaded and pool_size:
+        return PooledWSGIServer(host, port, app, pool_size, request_handler,
+                                passthrough_errors, queue_size)
     elif threaded:
         return ThreadedWSGIServer(host, port, app, request_handler,
                                   passthrough_errors)
+    elif processes > 1 and prefork:
+        return PreforkWSGIServer(host, port, app, processes, request_handler,
+                                 passthrough_errors, max_requests)
     elif processes > 1:
         return ForkingWSGIServer(host, port, app, processes, request_handler,
                                  passthrough_errors)
@@ -329,7 +1411,8 @@ def run_simple(hostname, port, application, use_reloader=False,
                use_debugger=False, use_evalex=True,
                extra_files=None, reloader_interval=1, threaded=False,
                processes=1, request_handler=None, static_files=None,
-               passthrough_errors=False):
+               passthrough_errors=False, prefork=False, max_requests=None,
+               pool_size=None, queue_size=None, event_loop=False):
     """Start an application using wsgiref and with an optional reloader.  This
     wraps `wsgiref` to fix the wrong default reporting of the multithreaded
     WSGI variable and adds optional multithreading and fork support.
@@ -364,6 +1447,21 @@ def run_simple(hostname, port, application, use_reloader=False,
     :param passthrough_errors: set this to `True` to disable the error catching.
                                This means that the server will die on errors but
                                it can be useful to hook debuggers in (pdb etc.)
+    :param prefork: if `True` and `processes` is greater than one the
+                    processes are forked once at startup and reused instead
+                    of forking one per request.
+    :param max_requests: the number of requests a preforked process handles
+                         before being replaced (`None` means no limit).
+    :param pool_size: if `threaded` is `True` handle the requests with a
+                      fixed pool of this many threads instead of a new
+                      thread per request.
+    :param queue_size: the number of connections that may wait for a thread
+                       of the pool, connections beyond that are rejected
+                       with a 503 response.  Defaults to four times the
+                       `pool_size`.
+    :param event_loop: if `True` connections are handled by an event loop
+                       and only the application runs in a pool of
+                       `pool_size` threads (10 by default).
     """
     if use_debugger:
         from werkzeug.debug import DebuggedApplication
@@ -375,7 +1473,8 @@ def run_simple(hostname, port, application, use_reloader=False,
     def inner():
         make_server(hostname, port, application, threaded,
                     processes, request_handler,
-                    passthrough_errors).serve_forever()
+                    passthrough_errors, prefork, max_requests, pool_size,
+                    queue_size, event_loop).serve_forever()
 
     if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
         display_hostname = hostname or '127.0.0.1'
@@ -98,6 +98,71 @@ class FileStorage(object):
         )
 
 
+class _DirectoryWatcher(object):
+    """Watches directories with inotify from a thread and calls `callback`
+    with the directory when something in it changes.  Use :meth:`create` that
+    returns `None` if inotify is not available.
+    """
+
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    # IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    in_ignored = 0x8000
+
+    def __init__(self, libc, fd, callback):
+        self.libc = libc
+        self.fd = fd
+        self.callback = callback
+        self.pid = os.getpid()
+        self.watches = {}
+        self.directories = set()
+
+    @classmethod
+    def create(cls, callback):
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            import thread
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            fd = libc.inotify_init()
+        except (ImportError, OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        watcher = cls(libc, fd, callback)
+        thread.start_new_thread(watcher.run, ())
+        return watcher
+
+    def watch(self, directory):
+        if directory in self.directories:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, directory, self.mask)
+        if wd >= 0:
+            self.watches[wd] = directory
+            self.directories.add(directory)
+
+    def run(self):
+        from struct import calcsize, unpack_from
+        header_size = calcsize('iIII')
+        while 1:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset + header_size <= len(data):
+                wd, mask, cookie, length = unpack_from('iIII', data, offset)
+                offset += header_size + length
+                directory = self.watches.get(wd)
+                if mask & self.in_ignored:
+                    self.watches.pop(wd, None)
+                    self.directories.discard(directory)
+                self.callback(directory)
+
+
 class SharedDataMiddleware(object):
     """A WSGI middleware that provides static content for development
     environments or simple server setups. Usage is quite simple::
@@ -116,6 +181,17 @@ class SharedDataMiddleware(object):
     the shared data middleware forwards all unhandled requests to the
     application, even if the requests are below one of the shared folders.
 
+    Files are passed to the server's file wrapper so servers that support it
+    (like the builtin one) can send them with `sendfile`.  The contents of
+    files up to `data_max_size` bytes are kept in memory.  Single byte range
+    requests (``Range`` and ``If-Range``) are answered with *206 Partial
+    Content*.
+
+    The lookup of the file for a path and its metadata (size, modification
+    time, etag and mimetype) are cached.  On Linux the cache is invalidated
+    using inotify, otherwise the metadata is checked again after
+    `stat_interval` seconds.
+
     If `pkg_resources` is available you can also tell the middleware to serve
     files from package data::
 
@@ -144,14 +220,31 @@ class SharedDataMiddleware(object):
     :param diallow: a list of :func:`~fnmatch.fnmatch` rules.
     :param cache: enable or disable caching headers.
     :Param cache_timeout: the cache timeout in seconds for the headers.
+    :param data_max_size: files up to this size in bytes are served from
+                          memory.  `0` disables it.
+    :param data_max_files: the maximum number of files kept in memory.
+    :param stat_interval: the number of seconds the metadata of a file is
+                          trusted if inotify is not available.
+    :param use_inotify: set this to `False` to disable the use of inotify.
+    :param max_entries: the maximum number of files in the metadata cache.
     """
 
     def __init__(self, app, exports, disallow=None, cache=True,
-                 cache_timeout=60 * 60 * 12):
+                 cache_timeout=60 * 60 * 12, data_max_size=64 * 1024,
+                 data_max_files=256, stat_interval=2, use_inotify=True,
+                 max_entries=1024):
         self.app = app
         self.exports = {}
         self.cache = cache
         self.cache_timeout = cache_timeout
+        self.data_max_size = data_max_size
+        self.data_max_files = data_max_files
+        self._data = {}
+        self.stat_interval = stat_interval
+        self.use_inotify = use_inotify
+        self.max_entries = max_entries
+        self._files = {}
+        self._watcher = None
         for key, value in exports.iteritems():
             if isinstance(value, tuple):
                 loader = self.get_package_loader(*value)
@@ -163,6 +256,10 @@ class SharedDataMiddleware(object):
             else:
                 raise TypeError('unknown def %r' % value)
             self.exports[key] = loader
+        # the exports by path without the trailing slash
+        self._index = {}
+        for key, loader in self.exports.iteritems():
+            self._index.setdefault(key.rstrip('/'), loader)
         if disallow is not None:
             from fnmatch import fnmatch
             self.is_allowed = lambda x: not fnmatch(x, disallow)
@@ -175,11 +272,73 @@ class SharedDataMiddleware(object):
         return True
 
     def _opener(self, filename):
-        return lambda: (
+        opener = lambda: (
             open(filename, 'rb'),
             datetime.utcfromtimestamp(os.path.getmtime(filename)),
             int(os.path.getsize(filename))
         )
+        # lets __call__ find the file without opening it
+        opener.filename = filename
+        return opener
+
+    def _get_data(self, filename, mtime, file_size):
+        """Return the contents of a file that is small enough to be kept
+        in memory or `None`.  The contents are cached until the modification
+        time or the size of the file change.
+        """
+        if not 0 < file_size <= self.data_max_size:
+            return None
+        key = (filename, mtime, file_size)
+        data = self._data.get(key)
+        if data is None:
+            f = open(filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if len(data) != file_size:
+                # changed since the metadata was read
+                return data
+            if len(self._data) >= self.data_max_files:
+                self._data.clear()
+            self._data[key] = data
+        return data
+
+    def get_range(self, environ, etag, mtime, file_size):
+        """Return the ``(start, stop)`` byte range requested by the
+        client, `None` if the whole file should be sent or ``(0, 0)`` if the
+        range can't be satisfied.  Only single ranges are supported, requests
+        for multiple ranges get the whole file.
+        """
+        value = environ.get('HTTP_RANGE', '').strip()
+        if not value.startswith('bytes=') or ',' in value or not file_size:
+            return None
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range:
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                if if_range != '"%s"' % etag:
+                    return None
+            else:
+                date = parse_date(if_range)
+                if date is None or mtime.replace(microsecond=0) > date:
+                    return None
+        start, sep, stop = value[6:].partition('-')
+        try:
+            if not start:
+                length = int(stop)
+                if length <= 0:
+                    return 0, 0
+                return max(file_size - length, 0), file_size
+            start = int(start)
+            if stop:
+                stop = min(int(stop) + 1, file_size)
+            else:
+                stop = file_size
+        except ValueError:
+            return None
+        if start >= file_size or stop <= start:
+            return 0, 0
+        return start, stop
 
     def get_file_loader(self, filename):
         return lambda x: (os.path.basename(filename), self._opener(filename))
@@ -224,6 +383,93 @@ class SharedDataMiddleware(object):
             adler32(real_filename) & 0xffffffff
         )
 
+    def find_file(self, path):
+        """Return the ``(real_filename, file_loader)`` for a sanitized path
+        using the longest export that is a prefix of it.
+        """
+        prefix = path
+        rest = None
+        while 1:
+            loader = self._index.get(prefix)
+            if loader is not None:
+                real_filename, file_loader = loader(rest)
+                if file_loader is not None:
+                    return real_filename, file_loader
+            if not prefix:
+                return None, None
+            prefix, tail = prefix.rsplit('/', 1)
+            if rest is None:
+                rest = tail
+            else:
+                rest = tail + '/' + rest
+
+    def _on_change(self, directory):
+        self._files.clear()
+
+    def _is_watching(self):
+        """Start the inotify watcher in this process if possible and return
+        `True` if it's running.
+        """
+        if not self.use_inotify:
+            return False
+        watcher = self._watcher
+        if watcher is not None and watcher.pid == os.getpid():
+            return True
+        # the watcher thread doesn't survive a fork, the entries checked by
+        # the parent may be stale
+        self._files.clear()
+        self._watcher = _DirectoryWatcher.create(self._on_change)
+        if self._watcher is None:
+            self.use_inotify = False
+            return False
+        return True
+
+    def get_entry(self, path):
+        """Return the cached ``(real_filename, file_loader, filename, mtime,
+        file_size, etag, mime_type, checked)`` tuple for path or `None` if
+        there is no file for it.  `filename` is `None` for files not on the
+        file system, the other values are then filled when the file is
+        opened.
+        """
+        watching = self._is_watching()
+        entry = self._files.get(path)
+        if entry is not None:
+            if watching:
+                return entry
+            now = time()
+            if now - entry[7] < self.stat_interval:
+                return entry
+        else:
+            now = time()
+
+        real_filename, file_loader = self.find_file(path)
+        if file_loader is None or not self.is_allowed(real_filename):
+            self._files.pop(path, None)
+            return None
+        mime_type = mimetypes.guess_type(real_filename)[0] or 'text/plain'
+        filename = getattr(file_loader, 'filename', None)
+        if filename is None:
+            return (real_filename, file_loader, None, None, None, None,
+                    mime_type, now)
+
+        if watching:
+            # watch before the stat so changes after it are not lost
+            self._watcher.watch(os.path.dirname(filename))
+        try:
+            st = os.stat(filename)
+        except OSError:
+            self._files.pop(path, None)
+            return None
+        mtime = datetime.utcfromtimestamp(st.st_mtime)
+        file_size = int(st.st_size)
+        entry = (real_filename, file_loader, filename, mtime, file_size,
+                 self.generate_etag(mtime, file_size, real_filename),
+                 mime_type, now)
+        if len(self._files) >= self.max_entries:
+            self._files.clear()
+        self._files[path] = entry
+        return entry
+
     def __call__(self, environ, start_response):
         # sanitize the path for non unix systems
         cleaned_path = environ.get('PATH_INFO', '').strip('/')
@@ -232,35 +478,43 @@ class SharedDataMiddleware(object):
                 cleaned_path = cleaned_path.replace(sep, '/')
         path = '/'.join([''] + [x for x in cleaned_path.split('/')
                                 if x and x != '..'])
-        file_loader = None
-        for search_path, loader in self.exports.iteritems():
-            if search_path == path:
-                real_filename, file_loader = loader(None)
-                if file_loader is not None:
-                    break
-            if not search_path.endswith('/'):
-                search_path += '/'
-            if path.startswith(search_path):
-                real_filename, file_loader = loader(path[len(search_path):])
-                if file_loader is not None:
-                    break
-        if file_loader is None or not self.is_allowed(real_filename):
+        entry = self.get_entry(path)
+        if entry is None:
             return self.app(environ, start_response)
 
-        guessed_type = mimetypes.guess_type(real_filename)
-        mime_type = guessed_type[0] or 'text/plain'
-        f, mtime, file_size = file_loader()
+        real_filename, file_loader, filename, mtime, file_size, etag, \
+            mime_type = entry[:7]
+        data = f = None
+        if filename is None:
+            f, mtime, file_size = file_loader()
+            etag = self.generate_etag(mtime, file_size, real_filename)
+        elif self.data_max_size:
+            try:
+                data = self._get_data(filename, mtime, file_size)
+            except (IOError, OSError, EnvironmentError):
+                data = None
+            if data is not None and len(data) != file_size:
+                # the cached metadata is stale, look the file up again
+                self._files.pop(path, None)
+                return self(environ, start_response)
+
+        if data is None and f is None:
+            try:
+                f = open(filename, 'rb')
+            except IOError:
+                self._files.pop(path, None)
+                return self.app(environ, start_response)
 
         headers = [('Date', http_date())]
         if self.cache:
             timeout = self.cache_timeout
-            etag = self.generate_etag(mtime, file_size, real_filename)
             headers += [
                 ('Etag', '"%s"' % etag),
                 ('Cache-Control', 'max-age=%d, public' % timeout)
             ]
             if not is_resource_modified(environ, etag, last_modified=mtime):
-                f.close()
+                if f is not None:
+                    f.close()
                 start_response('304 Not Modified', headers)
                 return []
             headers.append(('Expires', http_date(time() + timeout)))
@@ -269,11 +523,42 @@ class SharedDataMiddleware(object):
 
         headers.extend((
             ('Content-Type', mime_type),
-            ('Content-Length', str(file_size)),
-            ('Last-Modified', http_date(mtime))
+            ('Last-Modified', http_date(mtime)),
+            ('Accept-Ranges', 'bytes')
         ))
-        start_response('200 OK', headers)
-        return wrap_file(environ, f)
+
+        status = '200 OK'
+        start, stop = 0, file_size
+        if file_size:
+            byte_range = self.get_range(environ, etag, mtime, file_size)
+            if byte_range == (0, 0):
+                if f is not None:
+                    f.close()
+                headers.append(('Content-Range', 'bytes */%d' % file_size))
+                start_response('416 Requested Range Not Satisfiable', headers)
+                return []
+            elif byte_range is not None:
+                start, stop = byte_range
+                status = '206 Partial Content'
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                    start, stop - 1, file_size)))
+
+        if data is not None:
+            headers.append(('Content-Length', str(stop - start)))
+            start_response(status, headers)
+            if status == '200 OK':
+                return [data]
+            return [data[start:stop]]
+
+        if status == '200 OK':
+            headers.append(('Content-Length', str(file_size)))
+            start_response(status, headers)
+            return wrap_file(environ, f)
+
+        headers.append(('Content-Length', str(stop - start)))
+        start_response(status, headers)
+        f.seek(start)
+        return wrap_file(environ, f, length=stop - start)
 
 
 class DispatcherMiddleware(object):
@@ -367,11 +652,14 @@ class FileWrapper(object):
 
     :param file: a :class:`file`-like object with a :meth:`~file.read` method.
     :param buffer_size: number of bytes for one iteration.
+    :param length: the number of bytes to read from the current position of
+                   the file or `None` to read until the end.
     """
 
-    def __init__(self, file, buffer_size=8192):
+    def __init__(self, file, buffer_size=8192, length=None):
         self.file = file
         self.buffer_size = buffer_size
+        self.length = length
 
     def close(self):
         if hasattr(self.file, 'close'):
@@ -381,7 +669,13 @@ class FileWrapper(object):
         return self
 
     def next(self):
-        data = self.file.read(self.buffer_size)
+        if self.length is None:
+            data = self.file.read(self.buffer_size)
+        elif self.length > 0:
+            data = self.file.read(min(self.buffer_size, self.length))
+            self.length -= len(data)
+        else:
+            data = ''
         if data:
             return data
         raise StopIteration()
@@ -1485,12 +1779,17 @@ def responder(f):
     return _patch_wrapper(f, lambda *a: f(*a)(*a[-2:]))
 
 
-def wrap_file(environ, file, buffer_size=8192):
+def wrap_file(environ, file, buffer_size=8192, length=None):
     """Wraps a file.  This uses the WSGI server's file wrapper if available
     or otherwise the generic :class:`FileWrapper`.
 
     .. versionadded:: 0.5
 
+    If `length` is given only that number of bytes from the current position
+    of the file are sent.  The WSGI file wrapper can't be told about the
+    length so unless it's the :class:`FileWrapper` of the builtin server the
+    generic one is used in that case.
+
     If the file wrapper from the WSGI server is used it's important to not
     iterate over it from inside the application but to pass it through
     unchanged.  If you want to pass out a file wrapper inside a response
@@ -1500,7 +1799,10 @@ def wrap_file(environ, file, buffer_size=8192):
 
     :param file: a :class:`file`-like object with a :meth:`~file.read` method.
     :param buffer_size: number of bytes for one iteration.
+    :param length: the number of bytes to send or `None` for the whole file.
     """
+    if length is not None:
+        return FileWrapper(file, buffer_size, length)
     return environ.get('wsgi.file_wrapper', FileWrapper)(file, buffer_size)
 
 
@@ -1664,7 +1966,7 @@ class ArgumentValidationError(ValueError):
 
 # circular dependency fun
 from werkzeug.http import parse_multipart, parse_options_header, \
-     is_resource_modified
+     is_resource_modified, parse_date
 from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 from werkzeug.datastructures import MultiDict, TypeConversionDict
 